@@ -6,4 +6,5 @@ admin.site.register(Room)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['room', 'sender', 'message']
 
-admin.site.register(Message, MessageAdmin)
\ No newline at end of file
+admin.site.register(Message, MessageAdmin)
+admin.site.register(RoomMembership)
@@ -0,0 +1,162 @@
+# ChatApp/buffer.py
+
+import asyncio
+import atexit
+import itertools
+import logging
+import threading
+import uuid
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .counters import record_new_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+BUFFER_DEFAULTS = {
+    'ENABLED': False,
+    'MAX_BATCH_SIZE': 200,     # flush as soon as this many messages are waiting
+    'MAX_FLUSH_DELAY': 0.05,   # seconds a message may wait before it is written
+}
+
+
+def get_buffer_settings():
+    return {**BUFFER_DEFAULTS, **getattr(settings, 'CHAT_MESSAGE_BUFFER', {})}
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for chat messages.
+
+    Messages get a provisional id and ordering key straight away so they can be
+    broadcast, and are written with bulk_create once MAX_BATCH_SIZE messages are
+    waiting or MAX_FLUSH_DELAY has passed, whichever comes first.
+
+    If a bulk insert fails the batch is retried row by row, so one bad row (for
+    example a message whose room was deleted in the meantime) does not take the
+    rest of the batch with it. Rows that still fail are logged and dropped, and
+    counted in ``dropped``.
+
+    Provisional ids ("tmp-...") are never replaced by the database ids: clients
+    only see real ids once they reload history, so these messages cannot be
+    acknowledged or deleted over the socket until then.
+    """
+
+    def __init__(self, max_batch_size, max_flush_delay):
+        self.max_batch_size = max_batch_size
+        self.max_flush_delay = max_flush_delay
+        self.dropped = 0
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        # Batches handed to a flush task: id -> batch until a writer claims it
+        self._inflight = {}
+        self._writing = 0
+        self._idle = threading.Condition()
+        self._batch_ids = itertools.count(1)
+        self._sequence = itertools.count(1)
+        self._prefix = uuid.uuid4().hex[:8]
+
+    def enqueue(self, room_id, sender_id, message, status):
+        ordering = next(self._sequence)
+        self._pending.append(Message(room_id=room_id, sender_id=sender_id, message=message, status=status))
+        if len(self._pending) >= self.max_batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_flush_delay, self._start_flush)
+        return {
+            'id': f'tmp-{self._prefix}-{ordering}',
+            'ordering': ordering,
+            # The stored timestamp is taken at flush time, at most MAX_FLUSH_DELAY later
+            'timestamp': timezone.now().isoformat(),
+            'status': status,
+        }
+
+    async def flush(self):
+        # Write everything that is waiting and wait for in-flight batches
+        self._start_flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def drain(self, timeout=10):
+        """
+        Synchronous last-chance flush for interpreter shutdown, when the loop is
+        gone. Batches whose flush task never got to run are written here; batches
+        already being written are waited for, up to `timeout` seconds.
+        """
+        with self._idle:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batches = [self._pending, *self._inflight.values()]
+            self._pending = []
+            self._inflight.clear()
+        for batch in batches:
+            if batch:
+                self._write(batch)
+        with self._idle:
+            if not self._idle.wait_for(lambda: not self._writing, timeout):
+                logger.warning("Gave up waiting for %d buffered message writes", self._writing)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch_id = next(self._batch_ids)
+        with self._idle:
+            batch, self._pending = self._pending, []
+            self._inflight[batch_id] = batch
+        task = asyncio.get_running_loop().create_task(database_sync_to_async(self._write_inflight)(batch_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write_inflight(self, batch_id):
+        # Claim the batch so drain() neither writes it twice nor returns before it is stored
+        with self._idle:
+            batch = self._inflight.pop(batch_id, None)
+            if batch is None:
+                return
+            self._writing += 1
+        try:
+            self._write(batch)
+        finally:
+            with self._idle:
+                self._writing -= 1
+                self._idle.notify_all()
+
+    def _write(self, batch):
+        try:
+            Message.objects.bulk_create(batch)
+        except DatabaseError:
+            logger.exception("Bulk insert of %d buffered messages failed, retrying one by one", len(batch))
+        else:
+            # bulk_create skips post_save, so update room activity and unread counters here
+            record_new_messages(batch)
+            return
+        for msg in batch:
+            try:
+                msg.save()  # post_save keeps the counters in step for these
+            except DatabaseError:
+                self.dropped += 1
+                logger.exception("Dropping buffered message for room %s from user %s", msg.room_id, msg.sender_id)
+
+
+_message_buffer = None
+
+
+def get_message_buffer():
+    """Return the process-wide buffer, or None when write-behind is disabled."""
+    global _message_buffer
+    if _message_buffer is None:
+        conf = get_buffer_settings()
+        if not conf['ENABLED']:
+            return None
+        _message_buffer = MessageBuffer(conf['MAX_BATCH_SIZE'], conf['MAX_FLUSH_DELAY'])
+        atexit.register(_message_buffer.drain)
+    return _message_buffer
@@ -1,213 +1,568 @@
 # ChatApp/consumers.py
 
-import json
+import logging
+from functools import partial
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Room, Message # Make sure your models are imported
-from django.contrib.auth.models import User
-from django.utils import timezone
-from accounts.models import Profile
+from .models import Room, Message, MessageTombstone # Make sure your models are imported
+from .buffer import get_message_buffer
+from .counters import mark_room_delivered, mark_room_read, mark_room_read_through
+from .history_cache import get_history_cache
+from .indicators import TypingCoalescer, get_typing_settings
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, get_outbound_settings
+from .protocol import encode_frames, frame_for, negotiate
+from .ratelimit import check_rate
+from .receipts import ReceiptBatcher, advance_status, get_receipt_settings
+from .replay import get_replay_buffer
+from accounts.presence import get_presence
+
+# Users one socket may follow with subscribe_presence
+MAX_PRESENCE_SUBSCRIPTIONS = 500
+# Rooms one multiplexed socket may be subscribed to at once
+MAX_ROOM_SUBSCRIPTIONS = 200
+# Message ids one read_ids frame may acknowledge
+MAX_READ_IDS = 500
+
+logger = logging.getLogger(__name__)
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        self.room_ids = {}
+        self.rooms = set()
+        self.presence_subscriptions = {}
         # Ensure the user is authenticated before allowing WebSocket connection.
         # self.scope['user'] is populated by AuthMiddlewareStack in asgi.py.
         if not self.scope["user"].is_authenticated:
             await self.close() # Close the connection if the user is not authenticated
             return
 
-        self.room_name = f"room_{self.scope['url_route']['kwargs']['room_name']}"
-        room_name_param = self.scope['url_route']['kwargs']['room_name']
-        if room_name_param == 'global':
-            await self.channel_layer.group_add(f'user_{self.scope["user"].username}', self.channel_name)
-        else:
-            await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.channel_layer.group_add(f'user_{self.scope["user"].username}', self.channel_name)
-        await self.accept()
+        self.room = self.scope['url_route']['kwargs']['room_name']
+        self.start_batching()
+        # ?last_seq=<n>: the last room sequence number this client saw before reconnecting
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode('latin-1')).get('last_seq', [None])[0]
+        await self.channel_layer.group_add(f'user_{self.scope["user"].username}', self.channel_name)
+        # JSON unless the client offers the binary MessagePack subprotocol
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        self.open_outbound()
+        await self.accept(subprotocol=subprotocol)
         # Set user online
         await self.set_user_online()
-        # Mark all received unread messages as read
-        if room_name_param != 'global':
-            await self.mark_messages_read()
-            # Broadcast read event to the room
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'read_event',
-                    'username': self.scope['user'].username,
-                }
-            )
-        # Remove user notification group logic
+        # Join the room and mark all received unread messages as read
+        if self.room != 'global':
+            await self.join_room(self.room, int(last_seq) if last_seq and last_seq.isdigit() else None)
 
     async def disconnect(self, close_code):
         # Only attempt to discard from group if the user was authenticated and connected
         if self.scope["user"].is_authenticated:
-            room_name_param = self.scope['url_route']['kwargs']['room_name']
-            if room_name_param == 'global':
-                await self.channel_layer.group_discard(f'user_{self.scope["user"].username}', self.channel_name)
-            else:
-                await self.channel_layer.group_discard(self.room_name, self.channel_name)
-                await self.channel_layer.group_discard(f'user_{self.scope["user"].username}', self.channel_name)
-            # Remove user notification group logic
+            for room in list(self.rooms):
+                await self.leave_room(room)
+            await self.channel_layer.group_discard(f'user_{self.scope["user"].username}', self.channel_name)
+            for user_id in self.presence_subscriptions:
+                await self.channel_layer.group_discard(get_presence().group_name(user_id), self.channel_name)
+            await self.typing.close()
+            await self.outbound.close()
             # Set user offline and update last_seen
             await self.set_user_offline()
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message_content = text_data_json.get('message')
-        room_name = text_data_json.get('room_name')
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.decode_frame(text_data, bytes_data)
+        if data is None or await self.receive_presence(data):
+            return
+        # A per-room socket only ever talks to the room in its URL
+        if self.room != 'global':
+            await self.receive_room_frame(self.room, data)
+
+    async def decode_frame(self, text_data, bytes_data):
+        # A malformed frame gets an error frame back instead of closing the socket
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except (ValueError, TypeError):
+            data = None
+        if not isinstance(data, dict):
+            await self.send_payload('error', {'error': 'malformed_frame'})
+            return None
+        return data
+
+    async def receive_presence(self, data):
+        subscribe_presence = data.get('subscribe_presence')
+        unsubscribe_presence = data.get('unsubscribe_presence')
+        if subscribe_presence or unsubscribe_presence:
+            # Push-based replacement for polling the user-status endpoints
+            await self.update_presence_subscriptions(subscribe_presence or [], unsubscribe_presence or [])
+            return True
+        return False
+
+    async def receive_room_frame(self, room, data):
+        group = f'room_{room}'
+        message_content = data.get('message')
         sender_username = self.scope['user'].username
-        media_url = text_data_json.get('media_url')
-        delete_message_id = text_data_json.get('delete_message_id')
-        delete_for = text_data_json.get('delete_for')
-        typing_status = text_data_json.get('typing')
+        media_url = data.get('media_url')
+        delete_message_id = data.get('delete_message_id')
+        delete_for = data.get('delete_for')
+        typing_status = data.get('typing')
+        read_ids = data.get('read_ids')
+
+        user_id = self.scope['user'].id
+
+        if read_ids:
+            # Ids the client has shown; batched and applied like delivery receipts
+            batcher = self.receipt_batcher(room, 'read')
+            for message_id in (read_ids if isinstance(read_ids, list) else [read_ids])[:MAX_READ_IDS]:
+                if isinstance(message_id, int) and not isinstance(message_id, bool):
+                    batcher.add(message_id)
+            return
 
         if typing_status in ['start', 'stop']:
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'typing_event',
-                    'username': sender_username,
-                    'status': typing_status,
-                }
-            )
             # Only return if this is a typing-only event (no message content)
             if not message_content:
+                if not await self.rate_limited('typing', user_id, room):
+                    # Coalesced and rate limited; only real state changes reach the room
+                    self.typing.update(group, typing_status)
                 return
+            self.typing.update(group, typing_status)
 
         if delete_message_id:
+            if await self.rate_limited('delete', user_id, room):
+                return
+            message = await self.find_room_message(room, delete_message_id)
+            if message is None:
+                await self.send_payload('error', {
+                    'room_name': room,
+                    'error': 'invalid_message',
+                    'delete_message_id': delete_message_id,
+                })
+                return
+            if delete_for == 'me':
+                await self.delete_for_self(message)
             # Broadcast message deletion
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'delete_message',
-                    'message_id': delete_message_id,
-                    'delete_for': delete_for,
-                    'sender': sender_username,
-                }
-            )
+            await self.broadcast(group, 'delete_message', 'delete', {
+                'delete_message_id': message['id'],
+                'delete_for': delete_for,
+                'sender': sender_username,
+                'room_name': room,
+            })
             return
 
         if message_content:
+            # Each sender has a quota, and so does the room as a whole
+            if await self.rate_limited('message', user_id, room) or await self.rate_limited('room_message', room, room):
+                return
+            # Sending a message ends the typing indicator
+            self.typing.update(group, 'stop')
+            # Persist once here, on the sending connection, so recipients never touch the DB
+            saved = await self.create_message(data={
+                'sender': sender_username,
+                'message': message_content,
+                'room_name': room,
+            })
+            if saved is None:
+                return
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'sender': sender_username,
-                        'message': message_content,
-                        'room_name': room_name,
-                        'media_url': media_url,
-                    }
-                }
+            await self.broadcast(group, 'chat_message', 'message', {
+                'id': saved['id'],
+                'sender': sender_username,
+                'message': message_content,
+                'media_url': media_url,
+                'timestamp': saved['timestamp'],
+                'ordering': saved.get('ordering'),
+                'status': saved['status'],
+                'room_name': room,
+            }, id=saved['id'], sender=sender_username, room_name=room)
+
+    async def rate_limited(self, action, key, room):
+        # Token bucket per action and key; the client is told how long to back off
+        retry_after = await check_rate(action, key)
+        if not retry_after:
+            return False
+        await self.send_payload('error', {
+            'room_name': room,
+            'error': 'rate_limited',
+            'action': action,
+            'retry_after': round(retry_after, 2),
+        })
+        return True
+
+    def start_batching(self):
+        typing_conf = get_typing_settings()
+        self.typing = TypingCoalescer(self.publish_typing, typing_conf['INTERVAL'], typing_conf['EXPIRY'])
+        # One receipt batcher per joined room and status, created on first use
+        self.receipts = {}
+        # Replayed sequence numbers per room, not yet seen again from the group
+        self.replayed = {}
+
+    def receipt_batcher(self, room, status):
+        if (room, status) not in self.receipts:
+            conf = get_receipt_settings()
+            self.receipts[(room, status)] = ReceiptBatcher(
+                partial(self.apply_receipts, room, status), conf['MAX_BATCH_SIZE'], conf['MAX_DELAY'],
             )
+        return self.receipts[(room, status)]
+
+    async def join_room(self, room, last_seq=None):
+        self.rooms.add(room)
+        await self.channel_layer.group_add(f'room_{room}', self.channel_name)
+        if last_seq is not None:
+            # Reconnect: send what was missed instead of making the client reload history
+            await self.replay(room, last_seq)
+        # Opening the room reads what was waiting; each sender gets the ids back
+        unread = await self.mark_messages_read(room)
+        if unread:
+            await self.apply_receipts(room, 'read', unread)
+
+    async def replay(self, room, last_seq):
+        events, current = await get_replay_buffer().since(room, last_seq)
+        if events is None:
+            # Too far behind for the ring; the client pages the gap in from the database
+            await self.send_payload('resync', {'room_name': room, 'seq': current})
+            return
+        # The newest of these can arrive again through the group; dispatch() drops them
+        self.replayed.setdefault(room, set()).update(event['seq'] for event in events)
+        for event in events:
+            await getattr(self, event['type'])(event)
+
+    async def dispatch(self, message):
+        replayed = self.replayed.get(message.get('room_name')) if 'seq' in message else None
+        if replayed and message['seq'] in replayed:
+            replayed.discard(message['seq'])
+            return
+        await super().dispatch(message)
+
+    async def leave_room(self, room):
+        self.rooms.discard(room)
+        self.replayed.pop(room, None)
+        await self.channel_layer.group_discard(f'room_{room}', self.channel_name)
+        await self.typing.discard(f'room_{room}')
+        for key in [key for key in self.receipts if key[0] == room]:
+            await self.receipts.pop(key).flush()
+
+    async def broadcast(self, group, event_type, kind, payload, **extra):
+        # Encoded once here as JSON; recipients forward it as-is or transcode it once per process
+        if group.startswith('room_'):
+            # Room events are numbered and kept for replay to reconnecting clients
+            room = group[len('room_'):]
+
+            def build_event(seq):
+                return {
+                    'type': event_type,
+                    'frames': encode_frames(kind, {**payload, 'seq': seq}),
+                    **extra,
+                    'room_name': room,
+                    'seq': seq,
+                }
+            event = await get_replay_buffer().append(room, build_event)
+        else:
+            event = {'type': event_type, 'frames': encode_frames(kind, payload), **extra}
+        await self.channel_layer.group_send(group, event)
+
+    def open_outbound(self):
+        # Frames go through a bounded per-connection queue; handlers never wait on the client
+        conf = get_outbound_settings()
+        self.outbound = OutboundQueue(
+            self.send_frame, self.close_slow, self.codec.encode,
+            conf['MAX_FRAMES'], conf['SHED_TYPING_AT'], conf['COALESCE_RECEIPTS_AT'],
+        )
+
+    async def send_frame(self, data):
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def close_slow(self):
+        # Too far behind: the client reconnects with last_seq and is replayed the rest
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def send_encoded(self, kind, frames, receipt=None, typing=None):
+        self.outbound.put(kind, frame_for(self.codec, kind, frames), receipt, typing)
 
     # This method is called when an event with 'type': 'chat_message' is received by the consumer
     async def chat_message(self, event):
-        data = event['message'] # This 'message' key contains the dictionary sent from receive()
-
-        # Save the message to the database and get timestamp
-        timestamp = await self.create_message(data=data)
-        # Update message status to delivered for all except sender
-        await self.mark_message_delivered(data)
-
-        # Prepare response data to send back to the WebSocket
-        response_data = {
-            'sender': data['sender'],
-            'message': data['message'],
-            'media_url': data.get('media_url'),
-            'timestamp': timestamp,
-            'status': 'delivered',
-        }
-        # Send message to the WebSocket
-        await self.send(text_data=json.dumps({'message': response_data}))
-        # Unread badge notification logic removed
+        # The sender already saved and encoded the message, so just forward it
+        await self.send_encoded('message', event['frames'])
+        # Acknowledge other users' messages; receipts are batched per connection and room.
+        # Provisional write-behind ids have no row to update yet.
+        if event['sender'] != self.scope['user'].username and isinstance(event['id'], int):
+            if event['room_name'] in self.rooms:
+                self.receipt_batcher(event['room_name'], 'delivered').add(event['id'])
+
+    async def apply_receipts(self, room, status, message_ids):
+        moved = await self.store_receipts(room, status, message_ids)
+        # Receipts are not room events: each sender gets a frame with just their ids on
+        # their own user group, so nobody else receives them and they stay out of replay
+        for sender, ids in moved.items():
+            await self.broadcast(f'user_{sender}', 'receipt_event', 'receipt', {
+                'status': status,
+                'ids': ids,
+                'room_name': room,
+            }, status=status, ids=ids, room_name=room)
+
+    async def receipt_event(self, event):
+        # The payload lets a backed-up queue merge receipts for the room
+        await self.send_encoded('receipt', event['frames'], {
+            'status': event['status'],
+            'ids': event['ids'],
+            'room_name': event['room_name'],
+        })
 
     async def delete_message(self, event):
         # Notify clients to remove the message from UI
-        await self.send(text_data=json.dumps({
-            'delete_message_id': event['message_id'],
-            'delete_for': event['delete_for'],
-            'sender': event['sender'],
-        }))
+        await self.send_encoded('delete', event['frames'])
+
+    async def publish_typing(self, group, status):
+        await self.broadcast(group, 'typing_event', 'typing', {
+            'username': self.scope['user'].username,
+            'status': status,
+            'room_name': group[len('room_'):],
+        }, username=self.scope['user'].username, status=status)
 
     async def typing_event(self, event):
         # Send typing event to all users except the sender
         if self.scope['user'].username != event['username']:
-            await self.send(text_data=json.dumps({
-              'typing': {
-                 'username': event['username'],
-                  'status': event['status']
-                }
-        }))
-
-    async def read_event(self, event):
-        # Notify all users in the room that messages have been read by this user
-        if self.scope['user'].username != event['username']:
-            await self.send(text_data=json.dumps({
-                'read': {
-                    'username': event['username']
-                }
-            }))
+            # A backed-up queue keeps the latest stop per user and room
+            await self.send_encoded('typing', event['frames'], typing=(
+                event['room_name'], event['username'], event.get('status'),
+            ))
 
     async def new_group_event(self, event):
-        print(f"[DEBUG] new_group_event received in consumer for user {self.scope['user'].username}: {event['group_info']}")
-        await self.send(text_data=json.dumps({
-            'new_group': event['group_info']
-        }))
+        await self.send_encoded('new_group', event['frames'])
+
+    async def update_presence_subscriptions(self, subscribe, unsubscribe):
+        presence = get_presence()
+        # Accept a single username as well as a list
+        subscribe = [subscribe] if isinstance(subscribe, str) else [n for n in subscribe if isinstance(n, str)]
+        unsubscribe = {unsubscribe} if isinstance(unsubscribe, str) else {n for n in unsubscribe if isinstance(n, str)}
+        for user_id, username in list(self.presence_subscriptions.items()):
+            if username in unsubscribe:
+                del self.presence_subscriptions[user_id]
+                await self.channel_layer.group_discard(presence.group_name(user_id), self.channel_name)
+        subscribed = set(self.presence_subscriptions.values())
+        room_left = MAX_PRESENCE_SUBSCRIPTIONS - len(subscribed)
+        usernames = [name for name in dict.fromkeys(subscribe) if name not in subscribed][:max(room_left, 0)]
+        if not usernames:
+            return
+        snapshot = await database_sync_to_async(presence.snapshot)(usernames)
+        for username, (user_id, _, _) in snapshot.items():
+            self.presence_subscriptions[user_id] = username
+            await self.channel_layer.group_add(presence.group_name(user_id), self.channel_name)
+        # Current state first; presence_event pushes each change after that
+        await self.send_payload('presence', {'users': [
+            {
+                'username': username,
+                'status': 'online' if online else 'offline',
+                'last_seen': last_seen.isoformat() if last_seen else None,
+            }
+            for username, (_, online, last_seen) in snapshot.items()
+        ]})
+
+    async def presence_event(self, event):
+        username = self.presence_subscriptions.get(event['user_id'])
+        if username is None:
+            return
+        await self.send_payload('presence', {'users': [{
+            'username': username,
+            'status': 'online' if event['online'] else 'offline',
+            'last_seen': event['last_seen'],
+        }]})
+
+    async def send_payload(self, kind, payload):
+        # Per-connection frames (not broadcasts) are encoded for this socket only
+        self.outbound.put(kind, self.codec.encode(kind, payload))
+
 
+    async def set_user_online(self):
+        # Reference-counted in the cache; no Profile write per socket
+        await get_presence().connect(self.scope["user"].id)
+
+    async def set_user_offline(self):
+        # Goes offline only after the last socket has been closed for a grace period
+        await get_presence().disconnect(self.scope["user"].id)
 
     @database_sync_to_async
-    def set_user_online(self):
-        user = self.scope["user"]
-        profile, _ = Profile.objects.get_or_create(user=user)
-        profile.is_online = True
-        profile.save()
+    def store_receipts(self, room, status, message_ids):
+        """
+        Apply one batch of delivered or read receipts from this member. Only other
+        members' messages in the room count. Returns {sender username: [ids]} for
+        the messages that moved to `status`.
+        """
+        user_id = self.scope['user'].id
+        room_id = self.room_ids.get(room)
+        senders = dict(
+            Message.objects.filter(id__in=message_ids, room_id=room_id)
+            .exclude(sender_id=user_id).values_list('id', 'sender__username')
+        )
+        if not senders:
+            return {}
+        moved = advance_status(list(senders), status)
+        # Per-member receipt state is a single high-water mark, not a row per message
+        if status == 'read':
+            mark_room_read_through(room_id, user_id, max(senders))
+        else:
+            mark_room_delivered(room_id, user_id, max(senders))
+        if moved:
+            get_history_cache().update_status(room_id, status, message_ids=moved)
+        by_sender = {}
+        for message_id in sorted(moved):
+            by_sender.setdefault(senders[message_id], []).append(message_id)
+        return by_sender
+
+    async def find_room_message(self, room_name, message_id):
+        # Provisional write-behind ids ("tmp-...") have no row yet, and junk is never one
+        if isinstance(message_id, bool):
+            return None
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return None
+        return await database_sync_to_async(
+            Message.objects.filter(
+                id=message_id, room__room_name=room_name, room__participants=self.scope['user'],
+            ).values('id', 'room_id').first
+        )()
 
     @database_sync_to_async
-    def set_user_offline(self):
-        user = self.scope["user"]
-        profile, _ = Profile.objects.get_or_create(user=user)
-        profile.is_online = False
-        profile.last_seen = timezone.now()
-        profile.save()
+    def delete_for_self(self, message):
+        # Sparse tombstone; the message stays for everyone else
+        MessageTombstone.objects.get_or_create(
+            user=self.scope['user'], message_id=message['id'], defaults={'room_id': message['room_id']},
+        )
 
     @database_sync_to_async
-    def mark_messages_read(self):
+    def mark_messages_read(self, room_name):
+        # Opening a room reads it to the end; returns the ids whose senders have not seen that yet
         user = self.scope["user"]
-        room_name = self.scope['url_route']['kwargs']['room_name']
-        try:
-            room = Room.objects.get(room_name=room_name)
-            unread_msgs = Message.objects.filter(room=room, status__in=["sent", "delivered"]).exclude(sender=user)
-            unread_msgs.update(status="read")
-        except Room.DoesNotExist:
-            pass
+        room_id = Room.objects.filter(room_name=room_name).values_list('id', flat=True).first()
+        if room_id is None:
+            return []
+        self.room_ids[room_name] = room_id
+        mark_room_read(room_id, user.id)
+        return list(
+            Message.objects.filter(room_id=room_id, status__in=["sent", "delivered"])
+            .exclude(sender=user).values_list('id', flat=True)
+        )
+
+    async def create_message(self, data):
+        room_id = await self.get_room_id(data['room_name'])
+        if room_id is None:
+            logger.warning("Room %s does not exist; message from %s not saved", data['room_name'], data['sender'])
+            return None
+        buffer = get_message_buffer()
+        if buffer is not None:
+            # Write-behind: broadcast now with a provisional id, bulk insert shortly after.
+            # Provisional ids cannot be acknowledged, so these are stored as delivered.
+            return buffer.enqueue(room_id, self.scope['user'].id, data['message'], 'delivered')
+        return await self.save_message(room_id, data)
 
     @database_sync_to_async
-    def mark_message_delivered(self, data):
-        try:
-            room = Room.objects.get(room_name=data['room_name'])
-            msg = Message.objects.filter(room=room, sender__username=data['sender'], message=data['message']).order_by('-timestamp').first()
-            if msg and msg.status == 'sent':
-                msg.status = 'delivered'
-                msg.save()
-        except Room.DoesNotExist:
-            pass
+    def get_room_id(self, room_name):
+        # Resolved once per connection and room
+        if room_name not in self.room_ids:
+            self.room_ids[room_name] = Room.objects.filter(room_name=room_name).values_list('id', flat=True).first()
+        return self.room_ids[room_name]
 
     @database_sync_to_async
-    def create_message(self, data):
+    def save_message(self, room_id, data):
         try:
-            get_room_by_name = Room.objects.get(room_name=data['room_name'])
-            sender_user = User.objects.get(username=data['sender'])
-            new_message = Message(room=get_room_by_name, sender=sender_user, message=data['message'], status='sent')
-            new_message.save()
-            return new_message.timestamp.isoformat()  # Always return ISO timestamp
-        except Room.DoesNotExist:
-            print(f"Room with name {data['room_name']} does not exist.")
-        except User.DoesNotExist:
-            print(f"User with username {data['sender']} does not exist.")
-        except Exception as e:
-            print(f"Error saving message: {e}")
-            print(f"Room with name {data['room_name']} does not exist.")
+            # Recipients' sockets move it to delivered with batched receipts
+            new_message = Message.objects.create(
+                room_id=room_id,
+                sender=self.scope['user'],
+                message=data['message'],
+                status='sent',
+            )
+            return {
+                'id': new_message.id,
+                'timestamp': new_message.timestamp.isoformat(),  # Always return ISO timestamp
+                'status': new_message.status,
+            }
+        except Exception:
+            logger.exception("Error saving message for room %s", room_id)
         return None
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One socket per client for every room. The client joins and leaves rooms with
+    control frames instead of opening a socket per room:
+
+        {"subscribe": "group_x"}     -> {"subscribed": {"room_name": "group_x", "seq": 41}}
+        {"unsubscribe": "group_x"}   -> {"unsubscribed": {"room_name": "group_x"}}
+
+    A reconnecting client adds "last_seq" (a number, or a {room: seq} dict) to
+    its subscribe frame to have the events it missed replayed, or a "resync"
+    frame if it has to page them in from the history API instead.
+
+    Message, typing and delete frames name their room with "room_name" and are
+    only accepted for subscribed rooms; every room event sent back carries
+    "room_name" so the client can route it.
+    """
+
+    async def connect(self):
+        self.room_ids = {}
+        self.rooms = set()
+        self.presence_subscriptions = {}
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+        self.start_batching()
+        # new_group notifications arrive on the same socket
+        await self.channel_layer.group_add(f'user_{self.scope["user"].username}', self.channel_name)
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        self.open_outbound()
+        await self.accept(subprotocol=subprotocol)
+        await self.set_user_online()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.decode_frame(text_data, bytes_data)
+        if data is None or await self.receive_presence(data):
+            return
+        subscribe = data.get('subscribe')
+        unsubscribe = data.get('unsubscribe')
+        if subscribe or unsubscribe:
+            await self.update_room_subscriptions(subscribe or [], unsubscribe or [], data.get('last_seq'))
+            return
+        room = data.get('room_name')
+        if room not in self.rooms:
+            await self.send_payload('error', {'room_name': room, 'error': 'not_subscribed'})
+            return
+        await self.receive_room_frame(room, data)
+
+    async def update_room_subscriptions(self, subscribe, unsubscribe, last_seq=None):
+        # Accept a single room name as well as a list
+        subscribe = [subscribe] if isinstance(subscribe, str) else [n for n in subscribe if isinstance(n, str)]
+        # last_seq is a number for a single room or a {room name: seq} dict
+        if not isinstance(last_seq, dict):
+            last_seq = {subscribe[0]: last_seq} if len(subscribe) == 1 else {}
+        unsubscribe = [unsubscribe] if isinstance(unsubscribe, str) else [n for n in unsubscribe if isinstance(n, str)]
+        for room in dict.fromkeys(unsubscribe):
+            if room in self.rooms:
+                await self.leave_room(room)
+            await self.send_payload('unsubscribed', {'room_name': room})
+        for room in dict.fromkeys(subscribe):
+            if room in self.rooms:
+                await self.send_payload('subscribed', {'room_name': room})
+                continue
+            if len(self.rooms) >= MAX_ROOM_SUBSCRIPTIONS:
+                await self.send_payload('error', {'room_name': room, 'error': 'too_many_rooms'})
+                continue
+            if not await self.can_join(room):
+                await self.send_payload('error', {'room_name': room, 'error': 'forbidden'})
+                continue
+            seq = last_seq.get(room)
+            await self.join_room(room, seq if isinstance(seq, int) and not isinstance(seq, bool) else None)
+            await self.send_payload('subscribed', {
+                'room_name': room,
+                'seq': await get_replay_buffer().current(room),
+            })
+
+    @database_sync_to_async
+    def can_join(self, room_name):
+        # Only participants may follow a room; the id is kept for saving messages
+        room_id = Room.objects.filter(
+            room_name=room_name, participants=self.scope['user'],
+        ).values_list('id', flat=True).first()
+        if room_id is None:
+            return False
+        self.room_ids[room_name] = room_id
+        return True
@@ -0,0 +1,76 @@
+# ChatApp/counters.py
+
+from collections import Counter
+
+from django.db.models import Count, F, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .history_cache import get_history_cache
+from .models import Message, Room, RoomMembership
+
+
+def record_new_messages(messages):
+    """
+    Fold freshly saved messages into the denormalized room and membership state:
+    Room.last_message/last_activity and every other member's unread counter.
+    Costs one room update per room plus one membership update per (room, sender).
+    Cached room history is extended in place.
+    """
+    latest = {}
+    per_sender = Counter()
+    for msg in messages:
+        current = latest.get(msg.room_id)
+        if current is None or (msg.timestamp, msg.id) > (current.timestamp, current.id):
+            latest[msg.room_id] = msg
+        per_sender[(msg.room_id, msg.sender_id)] += 1
+
+    for room_id, msg in latest.items():
+        # Guard against an older batch landing after a newer one
+        Room.objects.filter(id=room_id).exclude(last_activity__gt=msg.timestamp).update(
+            last_message_id=msg.id,
+            last_activity=msg.timestamp,
+        )
+    for (room_id, sender_id), count in per_sender.items():
+        RoomMembership.objects.filter(room_id=room_id).exclude(user_id=sender_id).update(
+            unread_count=F('unread_count') + count,
+        )
+    get_history_cache().append_messages(messages)
+
+
+def mark_room_read(room_id, user_id):
+    # Reading a room moves the member's high-water mark to the room's latest message
+    last_message_id = Room.objects.filter(id=room_id).values_list('last_message_id', flat=True).first()
+    # Whatever has been read has also been delivered
+    RoomMembership.objects.filter(room_id=room_id, user_id=user_id).update(
+        last_delivered_message_id=last_message_id,
+        last_read_message_id=last_message_id,
+        unread_count=0,
+    )
+
+
+def mark_room_read_through(room_id, user_id, message_id):
+    # Read receipts from an open room: the read high-water mark only moves forward and the
+    # unread counter drops to the messages after it, in the same statement so a message
+    # counted by record_new_messages meanwhile is not lost
+    newer = (
+        Message.objects.filter(room_id=room_id, id__gt=message_id).exclude(sender_id=user_id)
+        .order_by().values('room_id').annotate(count=Count('id')).values('count')
+    )
+    RoomMembership.objects.filter(room_id=room_id, user_id=user_id).filter(
+        Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message_id)
+    ).update(last_read_message_id=message_id, unread_count=Coalesce(Subquery(newer), 0))
+    mark_room_delivered(room_id, user_id, message_id)
+
+
+def mark_room_delivered(room_id, user_id, message_id):
+    # Delivery high-water mark only moves forward
+    RoomMembership.objects.filter(room_id=room_id, user_id=user_id).filter(
+        Q(last_delivered_message__isnull=True) | Q(last_delivered_message_id__lt=message_id)
+    ).update(last_delivered_message_id=message_id)
+
+
+def sync_memberships(room, user_ids):
+    RoomMembership.objects.bulk_create(
+        [RoomMembership(room=room, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
@@ -0,0 +1,79 @@
+# ChatApp/export.py
+
+import csv
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from .models import Message
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_COLUMNS = ('id', 'timestamp', 'sender', 'message', 'media_url', 'status')
+
+
+def iter_room_history(room, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield every message of a room in (timestamp, id) order as plain dicts.
+    iterator() streams rows from the cursor in chunks instead of caching the
+    whole queryset, so memory stays flat however old the room is.
+    """
+    storage = Message._meta.get_field('media').storage
+    rows = (
+        Message.objects.filter(room=room)
+        .order_by('timestamp', 'id')
+        .values_list('id', 'timestamp', 'sender__username', 'message', 'media', 'status')
+        .iterator(chunk_size=chunk_size)
+    )
+    for pk, timestamp, sender, message, media, status in rows:
+        yield {
+            'id': pk,
+            'timestamp': timestamp.isoformat(),
+            'sender': sender,
+            'message': message,
+            'media_url': storage.url(media) if media else None,
+            'status': status,
+        }
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    # csv.writer only needs write(); hand each formatted line straight back
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow([row[column] if row[column] is not None else '' for column in EXPORT_COLUMNS])
+
+
+def export_lines(room, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    rows = iter_room_history(room, chunk_size=chunk_size)
+    return ndjson_lines(rows) if export_format == 'ndjson' else csv_lines(rows)
+
+
+async def aexport_lines(room, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Async variant for ASGI. Django buffers a sync iterator completely before
+    serving it asynchronously, so pull one chunk of lines at a time in the
+    sync thread instead.
+    """
+    lines = export_lines(room, export_format, chunk_size=chunk_size)
+    next_chunk = sync_to_async(lambda: ''.join(islice(lines, chunk_size)))
+    while True:
+        chunk = await next_chunk()
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,37 @@
+# ChatApp/fanout.py
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Concurrent group_send calls per fan-out; keeps a 1,000-member group from
+# opening a thousand channel layer requests at once
+MAX_CONCURRENT_SENDS = 100
+
+# Fan-outs still running; the loop only keeps weak references to its tasks
+_background = set()
+
+
+async def send_to_groups(channel_layer, groups, event):
+    """group_send one event to many groups concurrently; failures are logged, not raised."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+    async def send(group):
+        async with semaphore:
+            await channel_layer.group_send(group, event)
+
+    groups = list(groups)
+    results = await asyncio.gather(*(send(group) for group in groups), return_exceptions=True)
+    failed = [group for group, result in zip(groups, results) if isinstance(result, BaseException)]
+    if failed:
+        logger.error("group_send of %s failed for %d of %d groups", event.get('type'), len(failed), len(groups))
+    return len(groups) - len(failed)
+
+
+def send_in_background(coro):
+    """Run a fan-out on the current event loop without waiting for it."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
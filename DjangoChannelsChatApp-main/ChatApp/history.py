@@ -0,0 +1,100 @@
+# ChatApp/history.py
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+
+from .models import Message, MessageTombstone
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Columns fetched for history rows; values() skips model instantiation entirely
+MESSAGE_FIELDS = ('id', 'sender_id', 'sender__username', 'message', 'timestamp', 'media', 'status')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def cursor_key(timestamp, pk):
+    # (microseconds since epoch, id): a plain sortable tuple for the (timestamp, id) order
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds, pk
+
+
+def encode_cursor(timestamp, pk):
+    # "<microseconds since epoch>-<id>": exact, URL-safe and ordered like (timestamp, id)
+    micros, pk = cursor_key(timestamp, pk)
+    return f"{micros}-{pk}"
+
+
+def decode_cursor(value):
+    try:
+        micros, pk = value.rsplit('-', 1)
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError):
+        raise InvalidCursor(f"Invalid cursor: {value!r}")
+
+
+def serialize_message_row(row, user_id):
+    media = row['media']
+    return {
+        'id': row['id'],
+        'sender': row['sender__username'],
+        'sender_id': row['sender_id'],
+        'message': row['message'],
+        'timestamp': row['timestamp'].isoformat(),
+        'is_self': row['sender_id'] == user_id,
+        'media_url': Message._meta.get_field('media').storage.url(media) if media else None,
+        'status': row['status'],
+    }
+
+
+def page_queryset(room, user, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    # The reader's tombstones in this room are few; exclude them with one subquery
+    tombstones = MessageTombstone.objects.filter(room=room, user=user).values('message_id')
+    qs = Message.objects.filter(room=room).exclude(id__in=tombstones)
+    if after is not None:
+        ts, pk = after
+        qs = qs.filter(Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=pk)).order_by('timestamp', 'id')
+    else:
+        if before is not None:
+            ts, pk = before
+            qs = qs.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=pk))
+        qs = qs.order_by('-timestamp', '-id')
+    # One extra row tells whether another page exists
+    return qs.values(*MESSAGE_FIELDS)[:limit + 1]
+
+
+def build_page(rows, user, after=None, limit=DEFAULT_PAGE_SIZE):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is None:
+        rows.reverse()
+    return {
+        'messages': [serialize_message_row(row, user.id) for row in rows],
+        'has_more': has_more,
+        'before': encode_cursor(rows[0]['timestamp'], rows[0]['id']) if rows else None,
+        'after': encode_cursor(rows[-1]['timestamp'], rows[-1]['id']) if rows else None,
+    }
+
+
+def fetch_message_page(room, user, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return one page of a room's history in ascending (timestamp, id) order.
+
+    ``before``/``after`` are (timestamp, id) keys. Without either, the newest
+    page is returned. The result dict carries the rows, cursors for the first
+    and last row, and whether more rows exist in the direction being paged.
+    """
+    rows = list(page_queryset(room, user, before=before, after=after, limit=limit))
+    return build_page(rows, user, after=after, limit=limit)
+
+
+async def afetch_message_page(room, user, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Async version of fetch_message_page for async views."""
+    rows = [row async for row in page_queryset(room, user, before=before, after=after, limit=limit)]
+    return build_page(rows, user, after=after, limit=limit)
@@ -0,0 +1,216 @@
+# ChatApp/history_cache.py
+
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .history import MESSAGE_FIELDS, cursor_key, serialize_message_row
+from .models import Message, MessageTombstone
+from .receipts import STATUS_ORDER
+
+HISTORY_CACHE_DEFAULTS = {
+    'CACHE': 'chat_history',   # cache alias; give it LRU eviction (LocMem culls least recently used)
+    'SIZE': 200,               # most recent messages kept per room
+    'TIMEOUT': 3600,
+}
+
+
+def get_history_cache_settings():
+    return {**HISTORY_CACHE_DEFAULTS, **getattr(settings, 'CHAT_HISTORY_CACHE', {})}
+
+
+class HistoryCache:
+    """
+    Per-room cache of the newest SIZE history rows, shared by every reader.
+
+    Rows are stored without the reader-specific bits (is_self, tombstones), which
+    are applied when a page is served. Each reader's tombstones for the room are
+    cached alongside under their own version counter, bumped when one is added.
+    Each room has a version counter that every write bumps; an entry is only
+    served if it was written at the current version, so a racing writer in
+    another process can make an entry stale but never wrong.
+    New messages and status changes are applied to the entry in place
+    (write-through); deletes drop it. Writes run once the surrounding
+    transaction commits, so a rolled back message never reaches the cache.
+    """
+
+    def __init__(self, cache_alias, size, timeout):
+        self.cache_alias = cache_alias
+        self.size = size
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def entry_key(self, room_id):
+        return f'history:{room_id}'
+
+    def version_key(self, room_id):
+        return f'history:{room_id}:version'
+
+    def tombstone_key(self, room_id, user_id):
+        return f'history:{room_id}:tombstones:{user_id}'
+
+    def get_page(self, room, user, before=None, after=None, limit=50):
+        """Serve a page like fetch_message_page, or return None if the window does not cover it."""
+        if limit >= self.size:
+            return None
+        entry = self._load(room.id)
+        keys = entry['keys']
+        after_key = cursor_key(*after) if after is not None else None
+        before_key = cursor_key(*before) if before is not None else None
+        if not entry['complete']:
+            # Skip the tombstone lookup when the window plainly cannot cover the request
+            if after_key is not None and (not keys or after_key < keys[0]):
+                return None
+            if before_key is not None and (not keys or before_key <= keys[0]):
+                return None
+        tombstones = self.tombstones(room.id, user.id)
+        items = [(key, row) for key, row in zip(keys, entry['rows']) if row['id'] not in tombstones]
+        if after_key is not None:
+            selected = [item for item in items if item[0] > after_key]
+            has_more = len(selected) > limit
+            selected = selected[:limit]
+        else:
+            if before_key is not None:
+                items = [item for item in items if item[0] < before_key]
+            has_more = len(items) > limit
+            if not has_more and not entry['complete']:
+                # Older rows exist beyond the cached window
+                return None
+            selected = items[-limit:]
+        messages = [dict(row, is_self=row['sender_id'] == user.id) for _, row in selected]
+        return {
+            'messages': messages,
+            'has_more': has_more,
+            'before': self._cursor(selected[0][0]) if selected else None,
+            'after': self._cursor(selected[-1][0]) if selected else None,
+        }
+
+    def tombstones(self, room_id, user_id):
+        """Ids of the messages `user_id` deleted for themselves in the room."""
+        key = self.tombstone_key(room_id, user_id)
+        values = self.cache.get_many([key, f'{key}:version'])
+        cached = values.get(key)
+        version = values.get(f'{key}:version')
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+        # Read the version before the rows, so a tombstone added meanwhile makes this stale
+        self.cache.add(f'{key}:version', random.randrange(1 << 30), None)
+        version = self.cache.get(f'{key}:version')
+        tombstones = MessageTombstone.objects.filter(room_id=room_id, user_id=user_id)
+        ids = frozenset(tombstones.values_list('message_id', flat=True))
+        self.cache.set(key, (version, ids), self.timeout)
+        return ids
+
+    def tombstone_added(self, room_id, user_id):
+        def bump():
+            try:
+                self.cache.incr(f'{self.tombstone_key(room_id, user_id)}:version')
+            except ValueError:
+                pass
+        transaction.on_commit(bump)
+
+    def append_messages(self, messages):
+        by_room = {}
+        for msg in messages:
+            by_room.setdefault(msg.room_id, []).append(msg.id)
+        for room_id, ids in by_room.items():
+            def append(entry, ids=ids):
+                rows = Message.objects.filter(id__in=ids).values(*MESSAGE_FIELDS)
+                for row in rows:
+                    self._insert(entry, row)
+                del entry['keys'][:-self.size]
+                del entry['rows'][:-self.size]
+                # Trimming means older rows now exist beyond the window
+                if len(entry['keys']) == self.size:
+                    entry['complete'] = False
+            transaction.on_commit(lambda room_id=room_id, append=append: self._write_through(room_id, append))
+
+    def update_status(self, room_id, status, message_ids):
+        # Mirrors receipts.advance_status for cached rows
+        behind = STATUS_ORDER[:STATUS_ORDER.index(status)]
+        ids = set(message_ids)
+
+        def mutate(entry):
+            for row in entry['rows']:
+                if row['id'] in ids and row['status'] in behind:
+                    row['status'] = status
+        transaction.on_commit(lambda: self._write_through(room_id, mutate))
+
+    def invalidate(self, room_id):
+        def drop():
+            self._bump(room_id)
+            self.cache.delete(self.entry_key(room_id))
+        transaction.on_commit(drop)
+
+    def _load(self, room_id):
+        values = self.cache.get_many([self.entry_key(room_id), self.version_key(room_id)])
+        entry = values.get(self.entry_key(room_id))
+        version = values.get(self.version_key(room_id))
+        if entry is not None and version is not None and entry['version'] == version:
+            return entry
+        return self._fill(room_id)
+
+    def _fill(self, room_id):
+        # Random start so an evicted-and-recreated counter cannot match an old entry
+        self.cache.add(self.version_key(room_id), random.randrange(1 << 30), None)
+        version = self.cache.get(self.version_key(room_id))
+        newest = Message.objects.filter(room_id=room_id).order_by('-timestamp', '-id')
+        rows = list(newest.values(*MESSAGE_FIELDS)[:self.size])
+        rows.reverse()
+        entry = {'version': version, 'complete': len(rows) < self.size, 'keys': [], 'rows': []}
+        for row in rows:
+            self._insert(entry, row)
+        self.cache.set(self.entry_key(room_id), entry, self.timeout)
+        return entry
+
+    def _write_through(self, room_id, mutate):
+        entry = self.cache.get(self.entry_key(room_id))
+        version = self._bump(room_id)
+        if entry is None:
+            return
+        if version is None or entry['version'] != version - 1:
+            # Someone else wrote in between; let the next reader refill
+            self.cache.delete(self.entry_key(room_id))
+            return
+        mutate(entry)
+        entry['version'] = version
+        self.cache.set(self.entry_key(room_id), entry, self.timeout)
+
+    def _bump(self, room_id):
+        try:
+            return self.cache.incr(self.version_key(room_id))
+        except ValueError:
+            return None
+
+    def _insert(self, entry, row):
+        key = cursor_key(row['timestamp'], row['id'])
+        serialized = serialize_message_row(row, None)
+        del serialized['is_self']
+        # Appends are almost always at the end; walk back for the rare out-of-order row
+        position = len(entry['keys'])
+        while position and entry['keys'][position - 1] > key:
+            position -= 1
+        if position and entry['keys'][position - 1] == key:
+            return
+        entry['keys'].insert(position, key)
+        entry['rows'].insert(position, serialized)
+
+    def _cursor(self, key):
+        return f"{key[0]}-{key[1]}"
+
+
+_history_cache = None
+
+
+def get_history_cache():
+    """Return the process-wide history cache."""
+    global _history_cache
+    if _history_cache is None:
+        conf = get_history_cache_settings()
+        _history_cache = HistoryCache(conf['CACHE'], conf['SIZE'], conf['TIMEOUT'])
+    return _history_cache
@@ -0,0 +1,87 @@
+# ChatApp/indicators.py
+
+import asyncio
+import time
+
+from django.conf import settings
+
+TYPING_DEFAULTS = {
+    'INTERVAL': 1.0,   # at most one typing state change broadcast per user and room per interval
+    'EXPIRY': 6.0,     # a 'start' not refreshed within this many seconds becomes a 'stop'
+}
+
+
+def get_typing_settings():
+    return {**TYPING_DEFAULTS, **getattr(settings, 'CHAT_TYPING', {})}
+
+
+class TypingState:
+    def __init__(self):
+        self.typing = False       # what the client last told us
+        self.announced = False    # what the room was last told
+        self.last_sent = float('-inf')
+        self.sync_handle = None
+        self.expiry_handle = None
+
+
+class TypingCoalescer:
+    """
+    Server-side typing indicator state for one connection.
+
+    Clients send 'start' on every keystroke. Frames only update local state;
+    the room is told about a change at most once per INTERVAL, and only when
+    the state actually differs from what was last announced, so a start/stop
+    storm collapses into a single transition. A 'start' that is not refreshed
+    within EXPIRY seconds is turned into a 'stop' by the server.
+    """
+
+    def __init__(self, publish, interval, expiry):
+        self.publish = publish  # async callable(group, status)
+        self.interval = interval
+        self.expiry = expiry
+        self._states = {}
+        self._tasks = set()
+
+    def update(self, group, status):
+        state = self._states.setdefault(group, TypingState())
+        state.typing = status == 'start'
+        if state.expiry_handle is not None:
+            state.expiry_handle.cancel()
+            state.expiry_handle = None
+        if state.typing:
+            state.expiry_handle = asyncio.get_running_loop().call_later(self.expiry, self.update, group, 'stop')
+        self._sync(group, state)
+
+    async def discard(self, group):
+        # Connection left the group: cancel its timers and retract any visible indicator
+        state = self._states.pop(group, None)
+        if state is None:
+            return
+        for handle in (state.sync_handle, state.expiry_handle):
+            if handle is not None:
+                handle.cancel()
+        if state.announced:
+            await self.publish(group, 'stop')
+
+    async def close(self):
+        # Connection is going away
+        for group in list(self._states):
+            await self.discard(group)
+
+    def _sync(self, group, state):
+        if state.sync_handle is not None or state.typing == state.announced:
+            return
+        wait = state.last_sent + self.interval - time.monotonic()
+        if wait > 0:
+            # Too soon after the last broadcast; re-check once the interval has passed
+            state.sync_handle = asyncio.get_running_loop().call_later(wait, self._resync, group, state)
+            return
+        state.announced = state.typing
+        state.last_sent = time.monotonic()
+        task = asyncio.get_running_loop().create_task(self.publish(group, 'start' if state.typing else 'stop'))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _resync(self, group, state):
+        state.sync_handle = None
+        self._sync(group, state)
@@ -0,0 +1,113 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+
+from ChatApp.models import Message, Room
+
+BENCH_PREFIX = 'bench_room_'
+
+# The composite indexes added in 0007_message_indexes, and what they replaced
+COMPOSITE_INDEXES = list(Message._meta.indexes)
+BASELINE_INDEX = models.Index(fields=['room'], name='bench_message_room_idx')
+
+
+def hot_queries(room, user):
+    # The query shapes used by the history endpoint, the dashboard and read marking
+    newest = Message.objects.filter(room=room).order_by('-timestamp', '-id')
+    cursor_row = newest.values('timestamp', 'id')[200:201].first() or {'timestamp': None, 'id': 0}
+    return {
+        'history_newest_page': newest[:50],
+        'history_before_cursor': newest.filter(
+            models.Q(timestamp__lt=cursor_row['timestamp']) | models.Q(timestamp=cursor_row['timestamp'], id__lt=cursor_row['id'])
+        )[:50] if cursor_row['timestamp'] else newest[:50],
+        'latest_message': newest[:1],
+        'unread_for_reader': Message.objects.filter(room=room, status__in=['sent', 'delivered']).exclude(sender=user),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large message table and compare plans and latencies of the hot message "
+        "queries with the pre-0007 index (room only) and the composite indexes. "
+        "Run it against a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--skip-seed', action='store_true', help="Reuse rows from an earlier --keep run.")
+        parser.add_argument('--keep', action='store_true', help="Leave the seeded rows in place.")
+
+    def handle(self, *args, **options):
+        senders = [User.objects.get_or_create(username=f'bench_sender_{i}')[0] for i in range(5)]
+        if not options['skip_seed']:
+            self.seed(options['rows'], options['rooms'], options['batch_size'], senders)
+        rooms = list(Room.objects.filter(room_name__startswith=BENCH_PREFIX))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        with connection.schema_editor() as editor:
+            for index in COMPOSITE_INDEXES:
+                editor.remove_index(Message, index)
+            editor.add_index(Message, BASELINE_INDEX)
+        try:
+            self.report('before (room index only)', rooms, senders, options['repeat'])
+        finally:
+            with connection.schema_editor() as editor:
+                editor.remove_index(Message, BASELINE_INDEX)
+                for index in COMPOSITE_INDEXES:
+                    editor.add_index(Message, index)
+        self.report('after (composite indexes)', rooms, senders, options['repeat'])
+
+        if not options['keep']:
+            self.stdout.write("Removing seeded rows...")
+            for room in rooms:
+                room.delete()
+            User.objects.filter(id__in=[sender.id for sender in senders]).delete()
+
+    def seed(self, rows, room_count, batch_size, senders):
+        self.stdout.write(f"Seeding {rows} messages across {room_count} rooms on {connection.vendor}...")
+        existing = Room.objects.filter(room_name__startswith=BENCH_PREFIX).count()
+        Room.objects.bulk_create([
+            Room(room_name=f'{BENCH_PREFIX}{i}', room_type='group') for i in range(existing, room_count)
+        ])
+        room_ids = list(Room.objects.filter(room_name__startswith=BENCH_PREFIX).values_list('id', flat=True))
+        statuses = ['read'] * 8 + ['delivered', 'sent']
+        started = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            Message.objects.bulk_create([
+                Message(
+                    room_id=random.choice(room_ids),
+                    sender=random.choice(senders),
+                    message=f'benchmark message {offset + i}',
+                    status=random.choice(statuses),
+                )
+                for i in range(min(batch_size, rows - offset))
+            ])
+        self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    def report(self, label, rooms, senders, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(label))
+        samples = {}
+        plans = {}
+        for _ in range(repeat):
+            for name, qs in hot_queries(random.choice(rooms), random.choice(senders)).items():
+                plans.setdefault(name, qs.explain())
+                started = time.perf_counter()
+                if name == 'unread_for_reader':
+                    qs.count()
+                else:
+                    list(qs)
+                samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        for name, timings in samples.items():
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(f"  {name:<24} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+            for line in plans[name].splitlines():
+                self.stdout.write(f"      {line}")
@@ -0,0 +1,42 @@
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ChatApp.protocol import JSON_CODEC, MSGPACK_CODEC
+
+SAMPLE_EVENTS = {
+    'message': {
+        'id': 123456,
+        'sender': 'alice',
+        'message': 'Are we still on for the release review at 3pm?',
+        'media_url': None,
+        'timestamp': '2025-07-16T07:04:12.345678+00:00',
+        'ordering': None,
+        'status': 'delivered',
+    },
+    'typing': {'username': 'alice', 'status': 'start'},
+    'read': {'username': 'alice'},
+    'delete': {'delete_message_id': 123456, 'delete_for': 'everyone', 'sender': 'alice'},
+    'new_group': {'room_name': 'group_release', 'room_type': 'group', 'participants': ['alice', 'bob', 'carol']},
+}
+
+
+class Command(BaseCommand):
+    help = "Compare encode time and frame size of the JSON and MessagePack WebSocket protocols."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        if MSGPACK_CODEC is None:
+            raise CommandError("msgpack is not installed.")
+        iterations = options['iterations']
+        self.stdout.write(f"{'event':<10} {'json B':>7} {'msgpack B':>10} {'json us':>8} {'msgpack us':>11}")
+        for kind, payload in SAMPLE_EVENTS.items():
+            row = [kind]
+            timings = []
+            for codec in (JSON_CODEC, MSGPACK_CODEC):
+                row.append(len(codec.encode(kind, payload)))
+                seconds = timeit.timeit(lambda: codec.encode(kind, payload), number=iterations)
+                timings.append(seconds / iterations * 1e6)
+            self.stdout.write(f"{row[0]:<10} {row[1]:>7} {row[2]:>10} {timings[0]:>8.2f} {timings[1]:>11.2f}")
@@ -0,0 +1,106 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from ChatApp.history import fetch_message_page
+from ChatApp.models import Message, MessageTombstone, Room, RoomMembership
+
+BENCH_ROOM = 'bench_receipts_room'
+BENCH_USER_PREFIX = 'bench_member_'
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed one large group room and time the unread and history queries against the "
+        "high-water mark and tombstone tables. Run it against a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=10000)
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--tombstones', type=int, default=5000, help="Per-user deletions spread over members.")
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--keep', action='store_true', help="Leave the seeded rows in place.")
+
+    def handle(self, *args, **options):
+        room, members, message_ids = self.seed(options['members'], options['messages'], options['tombstones'])
+        try:
+            self.report(room, members, message_ids, options['repeat'])
+        finally:
+            if not options['keep']:
+                self.stdout.write("Removing seeded rows...")
+                room.delete()
+                User.objects.filter(username__startswith=BENCH_USER_PREFIX).delete()
+
+    def seed(self, member_count, message_count, tombstone_count):
+        self.stdout.write(f"Seeding {member_count} members and {message_count} messages...")
+        room = Room.objects.create(room_name=BENCH_ROOM, room_type='group')
+        User.objects.bulk_create(
+            [User(username=f'{BENCH_USER_PREFIX}{i}') for i in range(member_count)], batch_size=1000,
+        )
+        members = list(User.objects.filter(username__startswith=BENCH_USER_PREFIX))
+        Room.participants.through.objects.bulk_create(
+            [Room.participants.through(room=room, user=user) for user in members], batch_size=1000,
+        )
+        senders = members[:50]
+        for offset in range(0, message_count, 5000):
+            Message.objects.bulk_create([
+                Message(room=room, sender=random.choice(senders), message=f'benchmark message {offset + i}')
+                for i in range(min(5000, message_count - offset))
+            ])
+        message_ids = list(Message.objects.filter(room=room).order_by('id').values_list('id', flat=True))
+        # Most members are near the end of the room, a few are far behind
+        RoomMembership.objects.bulk_create([
+            RoomMembership(
+                room=room,
+                user=user,
+                last_delivered_message_id=message_ids[-1],
+                last_read_message_id=message_ids[max(0, len(message_ids) - 1 - int(random.expovariate(1 / 50)))],
+            )
+            for user in members
+        ], batch_size=1000, ignore_conflicts=True)
+        MessageTombstone.objects.bulk_create([
+            MessageTombstone(room=room, user=random.choice(members), message_id=random.choice(message_ids))
+            for _ in range(tombstone_count)
+        ], batch_size=1000, ignore_conflicts=True)
+        return room, members, message_ids
+
+    def report(self, room, members, message_ids, repeat):
+        memberships = {m.user_id: m for m in RoomMembership.objects.filter(room=room)}
+
+        def unread_from_high_water_mark(user):
+            mark = memberships[user.id].last_read_message_id or 0
+            return Message.objects.filter(room=room, id__gt=mark).exclude(sender=user).count()
+
+        def unread_from_counter(user):
+            return RoomMembership.objects.filter(room=room, user=user).values_list('unread_count', flat=True).first()
+
+        def history_page(user):
+            return fetch_message_page(room, user)
+
+        for name, query in (
+            ('unread (high-water mark)', unread_from_high_water_mark),
+            ('unread (counter column)', unread_from_counter),
+            ('history newest page', history_page),
+        ):
+            timings = []
+            for _ in range(repeat):
+                user = random.choice(members)
+                started = time.perf_counter()
+                query(user)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(f"  {name:<26} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+
+        receipt_rows = len(memberships)
+        tombstone_rows = MessageTombstone.objects.filter(room=room).count()
+        # The old is_read and delivered_to M2Ms needed a row per message and member once everyone caught up
+        m2m_rows = len(message_ids) * (len(members) - 1) * 2
+        self.stdout.write(
+            f"  receipt storage: {receipt_rows} membership rows + {tombstone_rows} tombstones "
+            f"vs up to {m2m_rows} is_read/delivered_to rows"
+        )
@@ -0,0 +1,87 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+
+from accounts.serializers import (
+    MessageSerializer, RoomSerializer, UserSerializer, message_data, room_data, user_data,
+)
+from ChatApp.models import Message, Room
+
+BENCH_PREFIX = 'bench_serializer_'
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare ModelSerializer and plain-function serialization of users, rooms and "
+        "messages. Seeded rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--participants', type=int, default=5, help="Members per seeded room.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                for size in options['sizes']:
+                    self.run_size(size, options['repeat'], options['participants'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run_size(self, size, repeat, participants):
+        users, rooms, messages = self.seed(size, participants)
+        self.stdout.write(f"{size} objects:")
+        for name, objects, model_serializer, fast in (
+            ('users', users, UserSerializer, user_data),
+            ('rooms', rooms, RoomSerializer, room_data),
+            ('messages', messages, MessageSerializer, message_data),
+        ):
+            slow_ms = self.time(lambda: model_serializer(objects, many=True).data, repeat)
+            fast_ms = self.time(lambda: [fast(obj) for obj in objects], repeat)
+            self.stdout.write(
+                f"  {name:<9} ModelSerializer {slow_ms:9.2f} ms   function {fast_ms:9.2f} ms   "
+                f"x{slow_ms / fast_ms:.1f}"
+            )
+
+    def seed(self, size, participants):
+        tag = f'{BENCH_PREFIX}{size}_'
+        User.objects.bulk_create([User(username=f'{tag}{i}') for i in range(size)], batch_size=1000)
+        users = list(User.objects.filter(username__startswith=tag).only('id', 'username'))
+        Room.objects.bulk_create(
+            [Room(room_name=f'{tag}room_{i}', room_type='group') for i in range(size)], batch_size=1000,
+        )
+        room_ids = list(Room.objects.filter(room_name__startswith=tag).values_list('id', flat=True))
+        Room.participants.through.objects.bulk_create([
+            Room.participants.through(room_id=room_id, user_id=users[(i + j) % size].id)
+            for i, room_id in enumerate(room_ids) for j in range(min(participants, size))
+        ], batch_size=1000, ignore_conflicts=True)
+        Message.objects.bulk_create([
+            Message(room_id=room_ids[i % len(room_ids)], sender=users[i], message=f'benchmark message {i}')
+            for i in range(size)
+        ], batch_size=1000)
+        participants_only = Prefetch('participants', queryset=User.objects.only('id', 'username'))
+        rooms = list(Room.objects.filter(id__in=room_ids).prefetch_related(participants_only))
+        messages = list(
+            Message.objects.filter(room_id__in=room_ids).select_related('room', 'sender').prefetch_related(
+                Prefetch('room__participants', queryset=User.objects.only('id', 'username'))
+            )
+        )
+        return users, rooms, messages
+
+    def time(self, serialize, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            serialize()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
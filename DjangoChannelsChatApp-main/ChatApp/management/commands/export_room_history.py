@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ChatApp.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_lines
+from ChatApp.models import Room
+
+
+class Command(BaseCommand):
+    help = "Stream a room's full message history to a file or stdout as NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_name')
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--output', help="File to write; defaults to stdout.")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(room_name=options['room_name'])
+        except Room.DoesNotExist:
+            raise CommandError(f"Room {options['room_name']!r} does not exist.")
+        lines = export_lines(room, options['format'], chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as out:
+                out.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
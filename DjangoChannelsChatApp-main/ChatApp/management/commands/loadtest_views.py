@@ -0,0 +1,216 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from urllib.parse import urlencode
+
+from channels.layers import InMemoryChannelLayer
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from ChatApp.models import Message, Room
+
+BENCH_PREFIX = 'loadtest_'
+
+
+class DelayedInMemoryChannelLayer(InMemoryChannelLayer):
+    # Stands in for a networked channel layer: every group_send costs a round trip
+    def __init__(self, latency=0.02, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def group_send(self, group, message):
+        await asyncio.sleep(self.latency)
+        await super().group_send(group, message)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent requests at the async chat views through the ASGI handler, then the "
+        "same requests through the WSGI handler with as many threads as ASGI has requests in "
+        "flight, and on a fixed pool of --pool threads, and compare. Seeded rows are removed "
+        "afterwards. The create_group scenario writes concurrently; on SQLite set OPTIONS "
+        "{'transaction_mode': 'IMMEDIATE'} or it mostly measures lock errors. At equal concurrency "
+        "expect similar req/s: async ORM calls still run on a thread and SQLite serializes the "
+        "writes. The fixed pool shows the ceiling async removes: a WSGI request holds its thread "
+        "while it waits on the channel layer, so raise --layer-latency and that row drops towards "
+        "pool / latency req/s while the ASGI row stays bound by the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=['create_group', 'messages'], default='create_group')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=32, help="In-flight requests on the ASGI side.")
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help="Worker threads on the WSGI side; defaults to --concurrency, the same number in flight.",
+        )
+        parser.add_argument(
+            '--pool', type=int, default=8,
+            help="Thread pool of a typical WSGI worker, run as an extra WSGI pass; 0 skips it.",
+        )
+        parser.add_argument('--members', type=int, default=20, help="Members per created group.")
+        parser.add_argument('--layer-latency', type=float, default=0.25, help="Seconds per group_send.")
+
+    def handle(self, *args, **options):
+        layers = {'default': {
+            'BACKEND': f'{__name__}.DelayedInMemoryChannelLayer',
+            'CONFIG': {'latency': options['layer_latency']},
+        }}
+        user, members, room = self.seed(options['members'])
+        try:
+            client = Client()
+            client.force_login(user)
+            cookie = f"sessionid={client.cookies['sessionid'].value}"
+            # One user fires every request, so room creation limits are off for the run
+            with override_settings(
+                CHANNEL_LAYERS=layers, ALLOWED_HOSTS=['testserver'], CHAT_RATE_LIMITS={'ENABLED': False},
+            ):
+                concurrency, threads, pool = (
+                    options['concurrency'], options['threads'] or options['concurrency'], options['pool'],
+                )
+                runs = [
+                    (f'ASGI, {concurrency} in flight', 'asgi', partial(self.run_asgi, concurrency)),
+                    (f'WSGI, {threads} threads', 'wsgi', partial(self.run_wsgi, threads)),
+                ]
+                if pool:
+                    runs.append((f'WSGI, {pool} threads', 'pool', partial(self.run_wsgi, pool)))
+                for label, tag, run in runs:
+                    requests = self.build_requests(options['scenario'], tag, options['requests'], members, room)
+                    peak_threads = ThreadPeak()
+                    with peak_threads:
+                        started = time.perf_counter()
+                        results = run(requests, cookie)
+                        elapsed = time.perf_counter() - started
+                    self.report(label, results, elapsed, peak_threads.peak)
+        finally:
+            Room.objects.filter(room_name__startswith=BENCH_PREFIX).delete()
+            User.objects.filter(username__startswith=BENCH_PREFIX).delete()
+
+    def seed(self, member_count):
+        user = User.objects.create_user(username=f'{BENCH_PREFIX}owner')
+        User.objects.bulk_create([User(username=f'{BENCH_PREFIX}member{i}') for i in range(member_count)])
+        members = list(
+            User.objects.filter(username__startswith=f'{BENCH_PREFIX}member').values_list('id', flat=True)
+        )
+        room = Room.objects.create(room_name=f'{BENCH_PREFIX}room', room_type='group')
+        room.participants.add(user)
+        Message.objects.bulk_create([
+            Message(room=room, sender=user, message=f'load test message {i}') for i in range(200)
+        ])
+        return user, members, room
+
+    def build_requests(self, scenario, tag, count, members, room):
+        if scenario == 'messages':
+            path = reverse('api_get_messages', args=[room.room_name])
+            return [('GET', path, b'') for _ in range(count)]
+        path = reverse('ajax_create_group_room')
+        user_ids = ','.join(map(str, members))
+        return [
+            ('POST', path, urlencode({'group_name': f'{BENCH_PREFIX}{tag}_{i}', 'user_ids': user_ids}).encode())
+            for i in range(count)
+        ]
+
+    def run_asgi(self, concurrency, requests, cookie):
+        application = get_asgi_application()
+
+        async def call(method, path, body):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': method, 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                'root_path': '', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+                'headers': [
+                    (b'host', b'testserver'),
+                    (b'cookie', cookie.encode()),
+                    (b'content-type', b'application/x-www-form-urlencoded'),
+                    (b'content-length', str(len(body)).encode()),
+                ],
+            }
+            status = None
+            sent = False
+
+            async def receive():
+                nonlocal sent
+                if sent:
+                    await asyncio.Event().wait()
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+
+            started = time.perf_counter()
+            await application(scope, receive, send)
+            return status, time.perf_counter() - started
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def limited(request):
+                async with semaphore:
+                    return await call(*request)
+
+            return await asyncio.gather(*(limited(request) for request in requests))
+
+        return asyncio.run(run_all())
+
+    def run_wsgi(self, threads, requests, cookie):
+        application = get_wsgi_application()
+
+        def call(request):
+            method, path, body = request
+            environ = {
+                'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+                'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_HOST': 'testserver', 'HTTP_COOKIE': cookie, 'REMOTE_ADDR': '127.0.0.1',
+                'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': BytesIO(body), 'wsgi.url_scheme': 'http', 'wsgi.errors': BytesIO(),
+                'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+                'wsgi.version': (1, 0),
+            }
+            status = []
+            started = time.perf_counter()
+            response = application(environ, lambda s, headers, exc_info=None: status.append(s))
+            b''.join(response)
+            if hasattr(response, 'close'):
+                response.close()
+            return int(status[0].split()[0]), time.perf_counter() - started
+
+        with ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(call, requests))
+
+    def report(self, label, results, elapsed, peak_threads):
+        latencies = sorted(latency * 1000 for _, latency in results)
+        errors = sum(1 for status, _ in results if status != 200)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(
+            f"{label:<20} {len(results) / elapsed:8.1f} req/s   median {statistics.median(latencies):8.1f} ms   "
+            f"p95 {p95:8.1f} ms   peak threads {peak_threads:4d}   errors {errors}"
+        )
+
+
+class ThreadPeak:
+    # Samples threading.active_count() in the background while a run is in progress
+    def __enter__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
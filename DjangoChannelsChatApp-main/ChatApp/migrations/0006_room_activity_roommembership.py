@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_activity(apps, schema_editor):
+    Room = apps.get_model('ChatApp', 'Room')
+    Message = apps.get_model('ChatApp', 'Message')
+    RoomMembership = apps.get_model('ChatApp', 'RoomMembership')
+
+    latest = Message.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+    Room.objects.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_activity=Subquery(latest.values('timestamp')[:1]),
+    )
+
+    Participant = Room.participants.through
+    for room_id, user_id in Participant.objects.values_list('room_id', 'user_id').iterator():
+        # Messages from others that have not been marked read count as unread
+        unread = Message.objects.filter(room_id=room_id, status__in=['sent', 'delivered']).exclude(sender_id=user_id).count()
+        RoomMembership.objects.create(room_id=room_id, user_id=user_id, unread_count=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0005_message_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ChatApp.message'),
+        ),
+        migrations.CreateModel(
+            name='RoomMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ChatApp.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='ChatApp.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'user'), name='unique_room_membership')],
+            },
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+    ]
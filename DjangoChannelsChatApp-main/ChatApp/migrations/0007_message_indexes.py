@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0006_room_activity_roommembership'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='message_room_ts_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'status'], name='message_room_status_idx'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='ChatApp.room'),
+        ),
+    ]
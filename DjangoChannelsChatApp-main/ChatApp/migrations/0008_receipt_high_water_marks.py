@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def copy_receipts(apps, schema_editor):
+    Message = apps.get_model('ChatApp', 'Message')
+    RoomMembership = apps.get_model('ChatApp', 'RoomMembership')
+    MessageTombstone = apps.get_model('ChatApp', 'MessageTombstone')
+
+    # Per-message M2M rows collapse into one high-water mark per (room, member)
+    for field, mark in (('is_read', 'last_read_message_id'), ('delivered_to', 'last_delivered_message_id')):
+        through = Message._meta.get_field(field).remote_field.through
+        marks = (
+            through.objects.values('user_id', 'message__room_id')
+            .annotate(max_id=Max('message_id'))
+            .order_by()
+        )
+        for row in marks.iterator():
+            RoomMembership.objects.filter(room_id=row['message__room_id'], user_id=row['user_id']).update(
+                **{mark: row['max_id']}
+            )
+
+    through = Message._meta.get_field('deleted_for').remote_field.through
+    batch = []
+    for row in through.objects.values('user_id', 'message_id', 'message__room_id').iterator():
+        batch.append(MessageTombstone(room_id=row['message__room_id'], user_id=row['user_id'], message_id=row['message_id']))
+        if len(batch) >= 1000:
+            MessageTombstone.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    MessageTombstone.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0007_message_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommembership',
+            name='last_delivered_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ChatApp.message'),
+        ),
+        migrations.CreateModel(
+            name='MessageTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='ChatApp.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ChatApp.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_tombstones', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'user'], name='tombstone_room_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'message'), name='unique_message_tombstone')],
+            },
+        ),
+        migrations.RunPython(copy_receipts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0008_receipt_high_water_marks'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='deleted_for',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='delivered_to',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
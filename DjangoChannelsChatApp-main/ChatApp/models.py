@@ -6,19 +6,20 @@ class Room(models.Model):
     room_name = models.CharField(max_length=255, unique=True)
     room_type = models.CharField(max_length=10)
     participants = models.ManyToManyField(User, related_name='chat_rooms')
+    # Denormalized by ChatApp.counters on every new message
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return f"{self.room_name} ({self.room_type})"
 
 
 class Message(models.Model):
-    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    # No single-column index: message_room_ts_id_idx below starts with room and covers it
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.ManyToManyField(User, related_name='read_messages', blank=True)
-    delivered_to = models.ManyToManyField(User, related_name='delivered_messages', blank=True)
-    deleted_for = models.ManyToManyField(User, related_name='deleted_messages', blank=True)
     media = models.FileField(upload_to='chat_media/', null=True, blank=True)
     STATUS_CHOICES = [
         ('sent', 'Sent'),
@@ -27,5 +28,50 @@ class Message(models.Model):
     ]
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
 
+    class Meta:
+        indexes = [
+            # History pages, latest message and keyset cursors: room filter + (timestamp, id) order
+            models.Index(fields=['room', 'timestamp', 'id'], name='message_room_ts_id_idx'),
+            # Read/delivered transitions filter a room by status
+            models.Index(fields=['room', 'status'], name='message_room_status_idx'),
+        ]
+
     def __str__(self):
         return f"{self.sender} in {self.room}: {str(self.message)[:20] if self.message else ''}"
+
+
+class RoomMembership(models.Model):
+    # One row per (room, participant), kept in sync with Room.participants by ChatApp.signals
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_memberships')
+    # High-water marks: every message up to these ids has been delivered to / read by this member
+    last_delivered_message = models.ForeignKey(Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_read_message = models.ForeignKey(Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='unique_room_membership'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.room} ({self.unread_count} unread)"
+
+
+class MessageTombstone(models.Model):
+    # Sparse per-user deletion: one row per message a user deleted for themselves
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='message_tombstones')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='tombstones')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message'], name='unique_message_tombstone'),
+        ]
+        indexes = [
+            # History excludes the reader's tombstones in one room
+            models.Index(fields=['room', 'user'], name='tombstone_room_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.message_id} deleted for {self.user}"
@@ -0,0 +1,197 @@
+# ChatApp/outbound.py
+
+import asyncio
+import logging
+import weakref
+from collections import Counter, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_DEFAULTS = {
+    'MAX_FRAMES': 1000,           # frames waiting for one socket before it is closed as too slow
+    'SHED_TYPING_AT': 100,        # typing frames are dropped once this many are waiting
+    'COALESCE_RECEIPTS_AT': 200,  # receipts for a room are merged into one frame from here on
+}
+
+# Close code for sockets that fell too far behind; the client reconnects with
+# its last seen sequence numbers and is replayed what it missed
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+def get_outbound_settings():
+    return {**OUTBOUND_DEFAULTS, **getattr(settings, 'CHAT_OUTBOUND', {})}
+
+
+class OutboundMetrics:
+    """Process-wide counters for outbound queues; depth is read from the live queues."""
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.sent = 0
+        self.dropped = Counter()
+        self.coalesced = 0
+        self.slow_disconnects = 0
+        self.peak_depth = 0
+
+    def snapshot(self):
+        depths = [len(queue) for queue in list(self.queues)]
+        return {
+            'connections': len(depths),
+            'queued_frames': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'peak_queue_depth': self.peak_depth,
+            'sent_frames': self.sent,
+            'dropped_frames': dict(self.dropped),
+            'coalesced_receipts': self.coalesced,
+            'slow_consumer_disconnects': self.slow_disconnects,
+        }
+
+
+_metrics = None
+
+
+def get_outbound_metrics():
+    """Return the process-wide outbound metrics."""
+    global _metrics
+    if _metrics is None:
+        _metrics = OutboundMetrics()
+    return _metrics
+
+
+class OutboundQueue:
+    """
+    Bounded, per-connection queue between the channel layer and one socket.
+
+    Consumer handlers put frames here and return at once, so a slow client
+    never holds up its channel (where the layer would drop events at capacity)
+    and never delays anyone else. A writer task sends the frames in order.
+    As the queue grows it first sheds typing frames, then merges delivery
+    receipts per room into one frame, and when MAX_FRAMES are waiting it
+    gives up and calls `overflow`, which closes the socket.
+
+    Shedding keeps the latest typing frame per room and user when it is a
+    "stop", so an indicator the client is already showing is still cleared;
+    dropped "start" frames are always followed by a stop from the sender.
+    """
+
+    def __init__(self, send, overflow, encode, max_frames, shed_typing_at, coalesce_receipts_at):
+        self.send = send            # async callable(data)
+        self.overflow = overflow    # async callable(), run once when the queue is full
+        self.encode = encode        # callable(kind, payload) -> data, for merged receipts
+        self.max_frames = max_frames
+        self.shed_typing_at = shed_typing_at
+        self.coalesce_receipts_at = coalesce_receipts_at
+        self.metrics = get_outbound_metrics()
+        self.metrics.queues.add(self)
+        self._items = deque()
+        self._typing_queued = 0
+        self._typing = {}            # (room name, username) -> latest queued typing item
+        self._receipts = {}          # (room name, status) -> queued receipt item that may still grow
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._writer = asyncio.get_running_loop().create_task(self._run())
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, kind, data, receipt=None, typing=None):
+        """
+        Queue one frame. `receipt` is the payload of a receipt frame, which lets
+        it be merged with a queued receipt for the same room under pressure, and
+        `typing` a (room name, username, status) tuple for typing frames.
+        """
+        if self._closed:
+            return
+        depth = len(self._items)
+        if depth >= self.max_frames:
+            self._give_up(kind)
+            return
+        if depth >= self.shed_typing_at:
+            if self._typing_queued:
+                self._shed_typing()
+            if kind == 'typing':
+                queued = self._typing.get(typing[:2]) if typing is not None else None
+                if queued is not None:
+                    # Only the latest state for this user and room matters
+                    queued[1], queued[3] = data, typing
+                    self.metrics.dropped['typing'] += 1
+                    return
+                if typing is None or typing[2] != 'stop':
+                    self.metrics.dropped['typing'] += 1
+                    return
+        if receipt is not None and depth >= self.coalesce_receipts_at:
+            queued = self._receipts.get((receipt['room_name'], receipt['status']))
+            if queued is not None:
+                merged = queued[2]
+                merged['ids'] = merged['ids'] + receipt['ids']
+                queued[1] = self.encode('receipt', merged)
+                self.metrics.coalesced += 1
+                return
+        item = [kind, data, dict(receipt) if receipt is not None else None, typing]
+        self._items.append(item)
+        if kind == 'typing':
+            self._typing_queued += 1
+            if typing is not None:
+                self._typing[typing[:2]] = item
+        if receipt is not None:
+            self._receipts[(receipt['room_name'], receipt['status'])] = item
+        self.metrics.peak_depth = max(self.metrics.peak_depth, len(self._items))
+        self._ready.set()
+
+    async def close(self):
+        self._closed = True
+        self._writer.cancel()
+        self.metrics.queues.discard(self)
+
+    def _shed_typing(self):
+        # Keep a typing frame only if it is the latest for its user and room and a stop
+        kept = deque(
+            item for item in self._items
+            if item[0] != 'typing'
+            or (item[3] is not None and item[3][2] == 'stop' and self._typing.get(item[3][:2]) is item)
+        )
+        self.metrics.dropped['typing'] += len(self._items) - len(kept)
+        self._items = kept
+        self._typing = {item[3][:2]: item for item in kept if item[0] == 'typing'}
+        self._typing_queued = 0
+
+    def _give_up(self, kind):
+        self._closed = True
+        self.metrics.dropped[kind] += 1
+        self.metrics.dropped['overflow'] += len(self._items)
+        self.metrics.slow_disconnects += 1
+        self._items.clear()
+        self._typing.clear()
+        self._receipts.clear()
+        self._writer.cancel()
+        self.metrics.queues.discard(self)
+        logger.warning("Closing slow WebSocket consumer after %d queued frames", self.max_frames)
+        task = asyncio.get_running_loop().create_task(self.overflow())
+        # Keep a reference until it has run
+        self._overflow_task = task
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._items:
+                item = self._items.popleft()
+                kind, data, receipt, typing = item
+                if kind == 'typing':
+                    self._typing_queued = max(self._typing_queued - 1, 0)
+                    if typing is not None and self._typing.get(typing[:2]) is item:
+                        del self._typing[typing[:2]]
+                if receipt is not None:
+                    key = (receipt['room_name'], receipt['status'])
+                    if self._receipts.get(key) is item:
+                        del self._receipts[key]
+                try:
+                    await self.send(data)
+                except Exception:
+                    # The socket is gone; disconnect() closes the queue
+                    logger.debug("Outbound send failed", exc_info=True)
+                    self._closed = True
+                    return
+                self.metrics.sent += 1
+            self._ready.clear()
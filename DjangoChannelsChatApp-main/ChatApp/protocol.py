@@ -0,0 +1,152 @@
+# ChatApp/protocol.py
+#
+# Wire formats for ChatConsumer frames.
+#
+# JSON (the default, or subprotocol "chat.json") keeps the original frame shape:
+#     {"message": {"sender": ..., "message": ..., ...}}
+#
+# MessagePack (subprotocol "chat.msgpack") sends binary frames with an explicit
+# event type code under "t" and the payload flattened onto short keys:
+#     {"t": 1, "s": "alice", "m": "hello", "ts": "...", ...}
+# Clients may send binary MessagePack frames with the same short keys.
+
+import json
+from functools import lru_cache
+
+try:
+    import msgpack
+except ImportError:  # optional dependency, only needed for the binary protocol
+    msgpack = None
+
+JSON_SUBPROTOCOL = 'chat.json'
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+# Event kinds; except for the flat 'delete' frame, each is also the top-level key of the JSON frame
+EVENT_CODES = {
+    'message': 1,
+    'typing': 2,
+    'read': 3,          # retired; read receipts are 'receipt' frames with status 'read'
+    'delete': 4,
+    'new_group': 5,
+    'receipt': 6,
+    'presence': 7,
+    'subscribed': 8,
+    'unsubscribed': 9,
+    'error': 10,
+    'resync': 11,
+}
+
+SHORT_KEYS = {
+    'id': 'i',
+    'sender': 's',
+    'message': 'm',
+    'media_url': 'u',
+    'timestamp': 'ts',
+    'ordering': 'o',
+    'status': 'st',
+    'username': 'n',
+    'delete_message_id': 'i',
+    'delete_for': 'f',
+    'room_name': 'r',
+    'room_type': 'rt',
+    'participants': 'p',
+    'typing': 'ty',
+    'ids': 'is',
+    'users': 'us',
+    'error': 'e',
+    'seq': 'q',
+    'action': 'a',
+    'retry_after': 'ra',
+}
+
+# Inbound short keys (client -> server) expanded back to the JSON field names
+LONG_KEYS = {
+    'm': 'message',
+    'r': 'room_name',
+    'u': 'media_url',
+    'ty': 'typing',
+    'i': 'delete_message_id',
+    'f': 'delete_for',
+    'sp': 'subscribe_presence',
+    'up': 'unsubscribe_presence',
+    'sr': 'subscribe',
+    'ur': 'unsubscribe',
+    'q': 'last_seq',
+    'ri': 'read_ids',
+}
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def encode(self, kind, payload):
+        # Same frames the consumer always sent; delete events are flat, the rest nested
+        if kind == 'delete':
+            return json.dumps(payload)
+        return json.dumps({kind: payload})
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, kind, payload):
+        frame = {'t': EVENT_CODES[kind]}
+        for key, value in payload.items():
+            if value is not None:
+                frame[SHORT_KEYS.get(key, key)] = value
+        return msgpack.packb(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Text frames are still accepted as JSON on a msgpack connection
+            return json.loads(text_data)
+        frame = msgpack.unpackb(bytes_data)
+        if not isinstance(frame, dict):
+            raise ValueError('MessagePack frames must be maps')
+        return {LONG_KEYS.get(key, key): value for key, value in frame.items()}
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+CODECS = {codec.name: codec for codec in (JSON_CODEC, MSGPACK_CODEC) if codec is not None}
+
+
+def encode_frames(kind, payload):
+    """
+    Encode one broadcast, keyed by codec name. Group events carry this so each
+    recipient forwards bytes instead of re-encoding. Only JSON is encoded up
+    front; other formats are derived by frame_for() when a recipient uses them.
+    """
+    return {JSON_CODEC.name: JSON_CODEC.encode(kind, payload)}
+
+
+def frame_for(codec, kind, frames):
+    """The frame for `codec`, transcoded from the JSON frame if it was not sent along."""
+    frame = frames.get(codec.name)
+    if frame is None:
+        frame = _transcode(codec.name, kind, frames[JSON_CODEC.name])
+    return frame
+
+
+@lru_cache(maxsize=256)
+def _transcode(codec_name, kind, json_frame):
+    # Every recipient gets its own copy of the event, so this is what keeps it to
+    # one encode per broadcast and process
+    payload = json.loads(json_frame)
+    if kind != 'delete':
+        payload = payload[kind]
+    return CODECS[codec_name].encode(kind, payload)
+
+
+def negotiate(subprotocols):
+    """Pick a codec and the subprotocol to accept from the client's offer."""
+    if MSGPACK_SUBPROTOCOL in subprotocols and MSGPACK_CODEC is not None:
+        return MSGPACK_CODEC, MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in subprotocols:
+        return JSON_CODEC, JSON_SUBPROTOCOL
+    return JSON_CODEC, None
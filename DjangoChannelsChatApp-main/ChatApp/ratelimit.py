@@ -0,0 +1,104 @@
+# ChatApp/ratelimit.py
+
+import math
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+RATE_LIMIT_DEFAULTS = {
+    'ENABLED': True,
+    # None keeps buckets in each process; a cache alias shares them between workers
+    'CACHE': None,
+    # action -> (tokens per second, burst). Keys are per user unless noted.
+    'LIMITS': {
+        'message': (2, 20),
+        'room_message': (20, 100),   # per room, all senders together
+        'typing': (5, 20),
+        'delete': (1, 10),
+        'create_room': (0.1, 10),
+    },
+    'MAX_KEYS': 100000,              # buckets kept in memory per process
+}
+
+
+def get_rate_limit_settings():
+    conf = {**RATE_LIMIT_DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMITS', {})}
+    conf['LIMITS'] = {**RATE_LIMIT_DEFAULTS['LIMITS'], **conf['LIMITS']}
+    return conf
+
+
+def refill(state, rate, burst, now):
+    # Take one token from a (tokens, updated) bucket; returns the new state and the wait
+    tokens, updated = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """Token buckets in this process, least recently used evicted past max_keys."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def take(self, key, rate, burst):
+        state, wait = refill(self._buckets.get(key), rate, burst, time.monotonic())
+        self._buckets[key] = state
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class CacheBuckets:
+    """
+    Token buckets in a shared cache. Read and write are not atomic, so workers
+    racing on one key may let a few extra requests through; the limit still holds
+    to within the number of workers.
+    """
+
+    def __init__(self, cache_alias):
+        self.cache_alias = cache_alias
+
+    async def take(self, key, rate, burst):
+        cache = caches[self.cache_alias]
+        key = f'ratelimit:{key}'
+        state, wait = refill(await cache.aget(key), rate, burst, time.time())
+        # An untouched bucket is full again after burst / rate seconds
+        await cache.aset(key, state, math.ceil(burst / rate) + 1)
+        return wait
+
+    def clear(self):
+        caches[self.cache_alias].clear()
+
+
+_buckets = {}
+
+
+def get_buckets(cache_alias=None):
+    """Return the process-wide bucket store for a cache alias, or the in-memory one for None."""
+    if cache_alias not in _buckets:
+        if cache_alias is None:
+            _buckets[None] = MemoryBuckets(get_rate_limit_settings()['MAX_KEYS'])
+        else:
+            _buckets[cache_alias] = CacheBuckets(cache_alias)
+    return _buckets[cache_alias]
+
+
+async def check_rate(action, key):
+    """
+    Spend one token from `action`'s bucket for `key`. Returns 0 when allowed,
+    otherwise the seconds until a token is available.
+    """
+    conf = get_rate_limit_settings()
+    if not conf['ENABLED'] or action not in conf['LIMITS']:
+        return 0
+    rate, burst = conf['LIMITS'][action]
+    return await get_buckets(conf['CACHE']).take(f'{action}:{key}', rate, burst)
@@ -0,0 +1,71 @@
+# ChatApp/receipts.py
+
+import asyncio
+
+from django.conf import settings
+
+from .models import Message
+
+RECEIPT_DEFAULTS = {
+    'MAX_BATCH_SIZE': 100,   # acknowledge as soon as this many message ids are waiting
+    'MAX_DELAY': 0.25,       # seconds a receipt may wait for company
+}
+
+STATUS_ORDER = [code for code, _ in Message.STATUS_CHOICES]
+
+
+def get_receipt_settings():
+    return {**RECEIPT_DEFAULTS, **getattr(settings, 'CHAT_RECEIPTS', {})}
+
+
+def advance_status(message_ids, status):
+    """
+    Move messages forward to `status` and return the ids that moved. Only rows
+    that are behind `status` change, so a message never goes from read back to
+    delivered. Every member of a room acknowledges the same messages, so the
+    rows are looked up first and the UPDATE is skipped when there is nothing
+    left to move.
+    """
+    behind = STATUS_ORDER[:STATUS_ORDER.index(status)]
+    pending = list(Message.objects.filter(id__in=message_ids, status__in=behind).values_list('id', flat=True))
+    if pending:
+        Message.objects.filter(id__in=pending, status__in=behind).update(status=status)
+    return pending
+
+
+class ReceiptBatcher:
+    """
+    Collects receipts of one status on one connection and hands them to `apply`
+    in batches, as a list of message ids.
+    """
+
+    def __init__(self, apply, max_batch_size, max_delay):
+        self.apply = apply
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    def add(self, message_id):
+        self._pending.append(message_id)
+        if len(self._pending) >= self.max_batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+
+    async def flush(self):
+        self._start_flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self.apply(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
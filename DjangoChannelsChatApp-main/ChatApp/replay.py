@@ -0,0 +1,98 @@
+# ChatApp/replay.py
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+REPLAY_DEFAULTS = {
+    'CACHE': 'chat_replay',   # cache alias; use a shared backend when running several workers
+    'SIZE': 500,              # most recent events kept per room
+    'TIMEOUT': 3600,
+}
+
+
+def get_replay_settings():
+    return {**REPLAY_DEFAULTS, **getattr(settings, 'CHAT_REPLAY', {})}
+
+
+class RoomReplayBuffer:
+    """
+    Bounded ring of each room's recent broadcast events, numbered by a per-room
+    sequence.
+
+    Every room event gets the next sequence number from an atomic counter and
+    is stored in slot seq % SIZE, overwriting the event SIZE places behind it.
+    A client that reconnects with the last sequence it saw gets the events after
+    it; if any of them has been overwritten or evicted, it is told to resync
+    from the database instead. Counters start from the clock, so a counter lost
+    with the cache never hands out numbers a client has already seen.
+    """
+
+    def __init__(self, cache_alias, size, timeout):
+        self.cache_alias = cache_alias
+        self.size = size
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def seq_key(self, room_name):
+        return f'replay:{room_name}:seq'
+
+    def slot_key(self, room_name, seq):
+        return f'replay:{room_name}:{seq % self.size}'
+
+    async def append(self, room_name, build_event):
+        """Number the next event, store `build_event(seq)` and return it."""
+        key = await self._start(room_name)
+        seq = await self.cache.aincr(key)
+        event = build_event(seq)
+        await self.cache.aset(self.slot_key(room_name, seq), (seq, event), self.timeout)
+        return event
+
+    async def current(self, room_name):
+        # Started here too, so a client joining a quiet room still gets a number to come back with
+        return await self.cache.aget(await self._start(room_name))
+
+    async def _start(self, room_name):
+        key = self.seq_key(room_name)
+        await self.cache.aadd(key, int(time.time()) * 1000000, None)
+        return key
+
+    async def since(self, room_name, last_seq):
+        """
+        (events after last_seq, current seq). Events are None when the ring no
+        longer covers the gap and the client has to resync from the database.
+        """
+        current = await self.current(room_name)
+        if current is None or last_seq > current or current - last_seq > self.size:
+            return None, current
+        seqs = range(last_seq + 1, current + 1)
+        slots = await self.cache.aget_many([self.slot_key(room_name, seq) for seq in seqs])
+        events = []
+        missing = False
+        for seq in seqs:
+            entry = slots.get(self.slot_key(room_name, seq))
+            if entry is None or entry[0] != seq:
+                # The newest events may still be on their way here through the group;
+                # a hole before a stored event means it was lost
+                missing = True
+                continue
+            if missing:
+                return None, current
+            events.append(entry[1])
+        return events, current
+
+
+_replay_buffer = None
+
+
+def get_replay_buffer():
+    """Return the process-wide replay buffer."""
+    global _replay_buffer
+    if _replay_buffer is None:
+        conf = get_replay_settings()
+        _replay_buffer = RoomReplayBuffer(conf['CACHE'], conf['SIZE'], conf['TIMEOUT'])
+    return _replay_buffer
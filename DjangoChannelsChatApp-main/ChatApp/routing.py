@@ -1,7 +1,8 @@
 from django.urls import path
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, MultiplexChatConsumer
 
 websocket_urlpatterns = [
+    path('ws/chat/', MultiplexChatConsumer.as_asgi()),  # One socket for every room
     path('ws/notification/<str:room_name>/', ChatConsumer.as_asgi()),
     path('ws/notification/global/', ChatConsumer.as_asgi()),  # Global notification socket
 ]
\ No newline at end of file
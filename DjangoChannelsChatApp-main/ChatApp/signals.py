@@ -0,0 +1,54 @@
+# ChatApp/signals.py
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .counters import record_new_messages, sync_memberships
+from .history_cache import get_history_cache
+from .models import Message, MessageTombstone, Room, RoomMembership
+
+
+@receiver(post_save, sender=Message)
+def message_created(sender, instance, created, raw=False, **kwargs):
+    # bulk_create skips this signal; ChatApp.buffer calls record_new_messages itself
+    if created and not raw:
+        record_new_messages([instance])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, origin=None, **kwargs):
+    # Deleting a room cascades to its messages; room_deleted drops the cache once for all of them
+    if isinstance(origin, Room) or getattr(origin, 'model', None) is Room:
+        return
+    get_history_cache().invalidate(instance.room_id)
+
+
+@receiver(post_save, sender=MessageTombstone)
+def tombstone_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        get_history_cache().tombstone_added(instance.room_id, instance.user_id)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    get_history_cache().invalidate(instance.id)
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # user.chat_rooms.add(...): instance is the user, pk_set holds room ids
+        if action == 'post_add':
+            for room in Room.objects.filter(id__in=pk_set):
+                sync_memberships(room, [instance.id])
+        elif action == 'post_remove':
+            RoomMembership.objects.filter(user=instance, room_id__in=pk_set).delete()
+        elif action == 'pre_clear':
+            RoomMembership.objects.filter(user=instance).delete()
+        return
+    if action == 'post_add':
+        sync_memberships(instance, pk_set)
+    elif action == 'post_remove':
+        RoomMembership.objects.filter(room=instance, user_id__in=pk_set).delete()
+    elif action == 'pre_clear':
+        RoomMembership.objects.filter(room=instance).delete()
@@ -1,3 +1,1185 @@
-from django.test import TestCase
+import asyncio
+import csv
+import importlib.util
+import json
+import multiprocessing
+import threading
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import Profile
+from accounts.presence import get_presence
+from .buffer import MessageBuffer
+from .counters import mark_room_read, mark_room_read_through
+from .export import aexport_lines
+from .fanout import send_to_groups
+from .history_cache import HistoryCache, get_history_cache
+from .indicators import TypingCoalescer
+from .models import Room, Message, MessageTombstone, RoomMembership
+from .consumers import ChatConsumer
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundMetrics, OutboundQueue
+from .protocol import (
+    EVENT_CODES, JSON_CODEC, JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, MsgpackCodec, _transcode, encode_frames, negotiate,
+)
+from .receipts import advance_status
+from .ratelimit import CacheBuckets, MemoryBuckets, get_buckets
+from .replay import RoomReplayBuffer, get_replay_buffer
+from .routing import websocket_urlpatterns
+
+
+class DashboardQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice')
+        self.client.force_login(self.user)
+
+    def add_rooms(self, start, count):
+        for i in range(start, start + count):
+            other = User.objects.create_user(username=f'user{i}')
+            Profile.objects.create(user=other, is_online=i % 2 == 0)
+            private = Room.objects.create(room_name=f'private_{i}', room_type='private')
+            private.participants.set([self.user, other])
+            group = Room.objects.create(room_name=f'group_{i}', room_type='group')
+            group.participants.set([self.user, other])
+            Room.objects.create(room_name=f'open_{i}', room_type='group').participants.add(other)
+            Message.objects.create(room=private, sender=other, message=f'hello {i}')
+            Message.objects.create(room=group, sender=other, message=f'hi all {i}')
+
+    def dashboard_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        self.add_rooms(0, 2)
+        _, few = self.dashboard_queries()
+        self.add_rooms(2, 20)
+        response, many = self.dashboard_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.context['private_rooms_info']), 22)
+
+    def test_room_info_values(self):
+        self.add_rooms(0, 1)
+        async_to_sync(get_presence().connect)(User.objects.get(username='user0').id)
+        room = Room.objects.get(room_name='private_0')
+        Message.objects.create(room=room, sender=self.user, message='latest')
+        response, _ = self.dashboard_queries()
+        info = response.context['private_rooms_info'][0]
+        self.assertEqual(info['last_message'], 'latest')
+        self.assertEqual(info['unread_count'], 1)
+        self.assertTrue(info['online_status'])
+        self.assertFalse(info['is_superuser'])
+        self.assertEqual(response.context['available_groups_info'][0]['unread_count'], 0)
+
+
+class RoomActivityCounterTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.room = Room.objects.create(room_name='group_counters', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+
+    def membership(self, user):
+        return RoomMembership.objects.get(room=self.room, user=user)
+
+    def test_new_messages_update_room_and_other_members(self):
+        Message.objects.create(room=self.room, sender=self.alice, message='one')
+        last = Message.objects.create(room=self.room, sender=self.alice, message='two')
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message, last)
+        self.assertEqual(self.room.last_activity, last.timestamp)
+        self.assertEqual(self.membership(self.bob).unread_count, 2)
+        self.assertEqual(self.membership(self.alice).unread_count, 0)
+
+    def test_mark_room_read_resets_counter(self):
+        last = Message.objects.create(room=self.room, sender=self.alice, message='one')
+        mark_room_read(self.room.id, self.bob.id)
+        membership = self.membership(self.bob)
+        self.assertEqual(membership.unread_count, 0)
+        self.assertEqual(membership.last_read_message, last)
+
+    def test_read_receipts_leave_only_newer_messages_unread(self):
+        ids = [Message.objects.create(room=self.room, sender=self.alice, message=f'm{i}').id for i in range(3)]
+        Message.objects.create(room=self.room, sender=self.bob, message='own')
+        mark_room_read_through(self.room.id, self.bob.id, ids[1])
+        membership = self.membership(self.bob)
+        self.assertEqual((membership.unread_count, membership.last_read_message_id), (1, ids[1]))
+        # An older receipt arriving late changes nothing
+        mark_room_read_through(self.room.id, self.bob.id, ids[0])
+        self.assertEqual(self.membership(self.bob).unread_count, 1)
+
+    def test_memberships_follow_participants(self):
+        self.room.participants.remove(self.bob)
+        self.assertFalse(RoomMembership.objects.filter(room=self.room, user=self.bob).exists())
+        self.bob.chat_rooms.add(self.room)
+        self.assertTrue(RoomMembership.objects.filter(room=self.room, user=self.bob).exists())
+
+
+class MessageBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.room = Room.objects.create(room_name='group_buffer', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+
+    def enqueue(self, buffer, count, room_id=None, settle=0):
+        async def run():
+            for i in range(count):
+                buffer.enqueue(room_id or self.room.id, self.alice.id, f'm{i}', 'delivered')
+            await asyncio.sleep(settle)
+            written = Message.objects.filter(room=self.room).acount()
+            counts = await written, buffer._timer is not None
+            await buffer.flush()
+            return counts
+
+        return async_to_sync(run)()
+
+    def test_full_batch_is_written_at_once(self):
+        buffer = MessageBuffer(max_batch_size=3, max_flush_delay=60)
+        # The third message fills the batch, so no timer is left waiting
+        self.assertEqual(self.enqueue(buffer, 3, settle=0.05), (3, False))
+
+    def test_partial_batch_waits_for_the_delay(self):
+        buffer = MessageBuffer(max_batch_size=100, max_flush_delay=0.02)
+        self.assertEqual(self.enqueue(buffer, 2), (0, True))
+        buffer = MessageBuffer(max_batch_size=100, max_flush_delay=0.02)
+        self.assertEqual(self.enqueue(buffer, 2, settle=0.1), (4, False))
+
+    def test_batch_updates_room_and_unread_counters(self):
+        self.enqueue(MessageBuffer(max_batch_size=100, max_flush_delay=60), 3)
+        self.room.refresh_from_db()
+        latest = Message.objects.filter(room=self.room).latest('timestamp', 'id')
+        self.assertEqual(self.room.last_message, latest)
+        self.assertEqual(RoomMembership.objects.get(room=self.room, user=self.bob).unread_count, 3)
+        self.assertEqual(RoomMembership.objects.get(room=self.room, user=self.alice).unread_count, 0)
+
+    def test_failed_bulk_insert_falls_back_to_single_rows(self):
+        buffer = MessageBuffer(max_batch_size=100, max_flush_delay=60)
+
+        async def run():
+            buffer.enqueue(self.room.id, self.alice.id, 'kept', 'delivered')
+            buffer.enqueue(self.room.id + 1000, self.alice.id, 'orphan', 'delivered')
+            await buffer.flush()
+
+        with self.assertLogs('ChatApp.buffer', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(list(Message.objects.values_list('message', flat=True)), ['kept'])
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(RoomMembership.objects.get(room=self.room, user=self.bob).unread_count, 1)
+
+    def test_drain_writes_pending_and_in_flight_batches_once(self):
+        buffer = MessageBuffer(max_batch_size=2, max_flush_delay=60)
+
+        async def run():
+            # Two full batches hand off to flush tasks, the fifth message is still pending
+            for i in range(5):
+                buffer.enqueue(self.room.id, self.alice.id, f'm{i}', 'delivered')
+            # drain() runs while the flush tasks race it for the same batches
+            await asyncio.to_thread(buffer.drain)
+            written = await Message.objects.acount()
+            await buffer.flush()
+            return written
+
+        self.assertEqual(async_to_sync(run)(), 5)
+        self.assertEqual(Message.objects.count(), 5)
+
+
+class MessageHistoryPaginationTests(TestCase):
+    def setUp(self):
+        caches['chat_history'].clear()
+        self.user = User.objects.create_user(username='alice')
+        self.client.force_login(self.user)
+        self.room = Room.objects.create(room_name='group_history', room_type='group')
+        self.room.participants.add(self.user)
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.user, message=f'm{i}').id
+            for i in range(7)
+        ]
+        self.url = reverse('api_get_messages', args=[self.room.room_name])
+
+    def test_pages_walk_backwards_without_gaps(self):
+        data = self.client.get(self.url, {'limit': 3}).json()
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[4:])
+        self.assertTrue(data['has_more'])
+        seen = [m['id'] for m in data['messages']]
+        while data['has_more']:
+            data = self.client.get(self.url, {'limit': 3, 'before': data['cursors']['before']}).json()
+            seen = [m['id'] for m in data['messages']] + seen
+        self.assertEqual(seen, self.ids)
+
+    def test_since_returns_only_newer_messages(self):
+        data = self.client.get(self.url, {'since': self.ids[4]}).json()
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[5:])
+        self.assertFalse(data['has_more'])
+
+    def test_deleted_for_user_is_hidden(self):
+        MessageTombstone.objects.create(room=self.room, user=self.user, message_id=self.ids[-1])
+        data = self.client.get(self.url).json()
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[:-1])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'nope'}).status_code, 400)
+
+
+class HistoryCacheTests(TestCase):
+    def setUp(self):
+        caches['chat_history'].clear()
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.client.force_login(self.alice)
+        self.room = Room.objects.create(room_name='group_cached', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.bob, message=f'm{i}').id
+            for i in range(5)
+        ]
+        self.url = reverse('api_get_messages', args=[self.room.room_name])
+
+    def fetch(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url, params).json()
+        message_queries = [q['sql'] for q in ctx.captured_queries if 'FROM "ChatApp_message"' in q['sql']]
+        return data, message_queries
+
+    def test_second_read_skips_message_table(self):
+        first, queries = self.fetch()
+        self.assertTrue(queries)
+        second, queries = self.fetch()
+        self.assertEqual(queries, [])
+        self.assertEqual(second['messages'], first['messages'])
+        self.assertEqual([m['id'] for m in second['messages']], self.ids)
+        self.assertFalse(second['messages'][0]['is_self'])
+
+    def test_new_messages_are_written_through(self):
+        newest = self.fetch()[0]['cursors']['after']
+        with self.captureOnCommitCallbacks(execute=True):
+            new_id = Message.objects.create(room=self.room, sender=self.alice, message='fresh').id
+        data, queries = self.fetch(after=newest)
+        self.assertEqual([m['id'] for m in data['messages']], [new_id])
+        self.assertTrue(data['messages'][0]['is_self'])
+        self.assertEqual(queries, [])
+
+    def test_status_changes_are_written_through(self):
+        self.fetch()
+        with self.captureOnCommitCallbacks(execute=True):
+            advance_status(self.ids[:2], 'delivered')
+            get_history_cache().update_status(self.room.id, 'delivered', message_ids=self.ids[:2])
+        data, _ = self.fetch()
+        self.assertEqual([m['status'] for m in data['messages']], ['delivered'] * 2 + ['sent'] * 3)
+
+    def test_delete_invalidates(self):
+        self.fetch()
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(id=self.ids[-1]).first().delete()
+        data, queries = self.fetch()
+        self.assertTrue(queries)
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[:-1])
+
+    def test_tombstones_apply_per_reader(self):
+        self.fetch()
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageTombstone.objects.create(room=self.room, user=self.alice, message_id=self.ids[0])
+        data, _ = self.fetch()
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[1:])
+        self.client.force_login(self.bob)
+        self.assertEqual([m['id'] for m in self.fetch()[0]['messages']], self.ids)
+
+    def test_tombstones_are_cached_per_reader(self):
+        history = get_history_cache()
+        history.get_page(self.room, self.alice)
+        with self.assertNumQueries(0):
+            history.get_page(self.room, self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageTombstone.objects.create(room=self.room, user=self.alice, message_id=self.ids[1])
+        with self.assertNumQueries(1):
+            page = history.get_page(self.room, self.alice)
+        self.assertNotIn(self.ids[1], [m['id'] for m in page['messages']])
+
+    def test_room_delete_invalidates_once(self):
+        self.fetch()
+        room_id = self.room.id
+        with mock.patch.object(HistoryCache, 'invalidate') as invalidate:
+            self.room.delete()
+        invalidate.assert_called_once_with(room_id)
+
+    def test_window_miss_falls_back(self):
+        history = HistoryCache('chat_history', size=3, timeout=60)
+        page = history.get_page(self.room, self.alice, limit=2)
+        self.assertEqual([m['id'] for m in page['messages']], self.ids[-2:])
+        self.assertTrue(page['has_more'])
+        # Only three rows are cached, so an older page has to come from the database
+        before = Message.objects.filter(id=self.ids[-2]).values_list('timestamp', 'id').first()
+        self.assertIsNone(history.get_page(self.room, self.alice, before=before, limit=2))
+
+
+class HistoryExportTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.room = Room.objects.create(room_name='group_export', room_type='group')
+        self.room.participants.add(self.alice)
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.alice, message=f'line {i}, "quoted"').id
+            for i in range(5)
+        ]
+        self.url = reverse('api_export_messages', args=[self.room.room_name])
+
+    def test_ndjson_streams_every_message(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.ids)
+        self.assertEqual(rows[0]['sender'], 'alice')
+
+    def test_csv_export(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(self.url, {'format': 'csv'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'timestamp', 'sender', 'message', 'media_url', 'status'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], self.ids)
+        self.assertEqual(rows[1][3], 'line 0, "quoted"')
+
+    def test_async_export_streams_chunks(self):
+        async def collect():
+            lines = aexport_lines(self.room, 'ndjson', chunk_size=2)
+            return [chunk async for chunk in lines]
+
+        chunks = async_to_sync(collect)()
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(''.join(chunks).splitlines()), 5)
+
+    def test_non_participant_is_refused(self):
+        self.client.force_login(User.objects.create_user(username='mallory'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class GroupCreationTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.client.force_login(self.alice)
+
+    def create_group(self, name, member_count):
+        User.objects.bulk_create([User(username=f'{name}_member{i}') for i in range(member_count)])
+        ids = list(User.objects.filter(username__startswith=f'{name}_member').values_list('id', flat=True))
+        with mock.patch('ChatApp.views.send_to_groups', new_callable=mock.AsyncMock) as fan_out_mock, \
+                CaptureQueriesContext(connection) as ctx:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('ajax_create_group_room'), {
+                    'group_name': name,
+                    'user_ids': ','.join(map(str, ids)),
+                })
+        self.assertEqual(response.status_code, 200)
+        return fan_out_mock, len(ctx.captured_queries)
+
+    def test_members_added_in_bulk_and_notified_once(self):
+        _, few = self.create_group('group_small', 3)
+        fan_out_mock, many = self.create_group('group_large', 100)
+        self.assertEqual(few, many)
+        room = Room.objects.get(room_name='group_large')
+        self.assertEqual(room.participants.count(), 101)
+        self.assertEqual(RoomMembership.objects.filter(room=room).count(), 101)
+        fan_out_mock.assert_called_once()
+        _, groups, event = fan_out_mock.call_args.args
+        self.assertEqual(len(groups), 101)
+        self.assertIn('user_alice', groups)
+        self.assertEqual(event['type'], 'new_group_event')
+
+    def test_send_to_groups_is_concurrent(self):
+        active = []
+
+        class Layer:
+            peak = 0
+
+            async def group_send(self, group, event):
+                active.append(group)
+                Layer.peak = max(Layer.peak, len(active))
+                await asyncio.sleep(0.01)
+                active.remove(group)
+
+        sent = async_to_sync(send_to_groups)(Layer(), [f'user_{i}' for i in range(50)], {'type': 'x'})
+        self.assertEqual(sent, 50)
+        self.assertEqual(Layer.peak, 50)
+
+    async def test_asgi_response_does_not_wait_for_fan_out(self):
+        released, delivered = asyncio.Event(), asyncio.Event()
+
+        async def slow_send(channel_layer, groups, event):
+            await released.wait()
+            delivered.set()
+
+        await self.async_client.aforce_login(self.alice)
+        with mock.patch('ChatApp.views.send_to_groups', slow_send):
+            response = await asyncio.wait_for(
+                self.async_client.post(reverse('ajax_create_group_room'), {'group_name': 'group_async'}), 5,
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(delivered.is_set())
+        released.set()
+        await asyncio.wait_for(delivered.wait(), 5)
+
+
+class TypingCoalescerTests(unittest.TestCase):
+    def run_storm(self, frames, settle):
+        published = []
+
+        async def publish(group, status):
+            published.append(status)
+
+        async def run():
+            coalescer = TypingCoalescer(publish, interval=0.05, expiry=0.2)
+            for status in frames:
+                coalescer.update('room_test', status)
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(settle)
+            await coalescer.close()
+
+        async_to_sync(run)()
+        return published
+
+    def test_storm_collapses_to_one_start(self):
+        self.assertEqual(self.run_storm(['start', 'stop'] * 10 + ['start'], 0.1), ['start', 'stop'])
+        self.assertEqual(self.run_storm(['start'] * 20, 0.01), ['start', 'stop'])
+
+    def test_start_then_stop_within_interval_is_delayed_not_lost(self):
+        self.assertEqual(self.run_storm(['start', 'stop'], 0.1), ['start', 'stop'])
+
+    def test_start_expires_on_the_server(self):
+        self.assertEqual(self.run_storm(['start'], 0.3), ['start', 'stop'])
+
+
+class OutboundQueueTests(unittest.TestCase):
+    def run_queue(self, frames):
+        # The first frame is taken by the writer and stalls until everything is queued
+        sent, closed = [], []
+
+        async def run():
+            stalled = asyncio.Event()
+
+            async def send(data):
+                await stalled.wait()
+                sent.append(data)
+
+            async def overflow():
+                closed.append(True)
+
+            queue = OutboundQueue(send, overflow, JSON_CODEC.encode, max_frames=8, shed_typing_at=3, coalesce_receipts_at=4)
+            for kind, data, receipt, *typing in frames:
+                queue.put(kind, data, receipt, *typing)
+                await asyncio.sleep(0)
+            stalled.set()
+            await asyncio.sleep(0.01)
+            await queue.close()
+
+        with mock.patch('ChatApp.outbound._metrics', OutboundMetrics()) as metrics:
+            async_to_sync(run)()
+        return sent, closed, metrics.snapshot()
+
+    def receipt(self, room, ids):
+        payload = {'status': 'delivered', 'ids': ids, 'room_name': room}
+        return ('receipt', JSON_CODEC.encode('receipt', payload), payload)
+
+    def test_typing_is_shed_first(self):
+        sent, closed, metrics = self.run_queue([
+            ('message', 'm0', None), ('typing', 't1', None), ('typing', 't2', None),
+            ('message', 'm1', None), ('typing', 't3', None), ('message', 'm2', None),
+        ])
+        self.assertEqual(sent, ['m0', 'm1', 'm2'])
+        self.assertEqual(metrics['dropped_frames'], {'typing': 3})
+        self.assertEqual(closed, [])
+
+    def typing(self, data, username, status):
+        return ('typing', data, None, ('room', username, status))
+
+    def test_latest_typing_stop_survives_shedding(self):
+        sent, closed, metrics = self.run_queue([
+            ('message', 'm0', None),
+            self.typing('alice start', 'alice', 'start'),
+            self.typing('bob start', 'bob', 'start'),
+            self.typing('alice stop', 'alice', 'stop'),
+            ('message', 'm1', None),
+            self.typing('bob stop', 'bob', 'stop'),
+            ('message', 'm2', None),
+            # Past the threshold: new starts are dropped, a queued state is replaced in place
+            self.typing('carol start', 'carol', 'start'),
+            self.typing('alice start again', 'alice', 'start'),
+            self.typing('alice stop again', 'alice', 'stop'),
+        ])
+        self.assertEqual(sent, ['m0', 'alice stop again', 'm1', 'bob stop', 'm2'])
+        self.assertEqual(metrics['dropped_frames'], {'typing': 5})
+
+    def test_receipts_are_coalesced_per_room(self):
+        sent, closed, metrics = self.run_queue(
+            [('message', f'm{i}', None) for i in range(5)]
+            + [self.receipt('a', [1]), self.receipt('a', [2]), self.receipt('b', [3])]
+        )
+        self.assertEqual(sent[:5], [f'm{i}' for i in range(5)])
+        self.assertEqual([json.loads(frame)['receipt']['ids'] for frame in sent[5:]], [[1, 2], [3]])
+        self.assertEqual(metrics['coalesced_receipts'], 1)
+
+    def test_full_queue_closes_the_socket(self):
+        sent, closed, metrics = self.run_queue([('message', f'm{i}', None) for i in range(10)])
+        self.assertEqual(closed, [True])
+        self.assertEqual(sent, [])
+        self.assertEqual(metrics['slow_consumer_disconnects'], 1)
+        self.assertEqual(metrics['dropped_frames'], {'message': 1, 'overflow': 8})
+        self.assertEqual(metrics['connections'], 0)
+
+
+class SlowConsumerTests(TransactionTestCase):
+    def test_stalled_member_does_not_hold_up_the_room(self):
+        self.addCleanup(get_presence().drain)
+        users = [User.objects.create_user(username=name) for name in ('alice', 'bob', 'carol')]
+        room = Room.objects.create(room_name='group_slow', room_type='group')
+        room.participants.add(*users)
+        send_frame = ChatConsumer.send_frame
+
+        async def stalled_for_bob(consumer, data):
+            if consumer.scope['user'].username == 'bob':
+                await asyncio.Event().wait()
+            await send_frame(consumer, data)
+
+        async def chat():
+            sockets = {}
+            for user in users:
+                sockets[user.username] = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/'
+                )
+                sockets[user.username].scope['user'] = user
+                await sockets[user.username].connect()
+            for i in range(10):
+                await sockets['alice'].send_json_to({'message': f'm{i}', 'room_name': room.room_name})
+            received = []
+            while len(received) < 10:
+                frame = await sockets['carol'].receive_json_from(5)
+                if 'message' in frame:
+                    received.append(frame['message']['message'])
+            closed = await sockets['bob'].receive_output(5)
+            for name in ('alice', 'carol'):
+                await sockets[name].disconnect()
+            return received, closed
+
+        with mock.patch.object(ChatConsumer, 'send_frame', stalled_for_bob), \
+                override_settings(CHAT_OUTBOUND={'MAX_FRAMES': 3, 'SHED_TYPING_AT': 2, 'COALESCE_RECEIPTS_AT': 2}):
+            received, closed = async_to_sync(chat)()
+        self.assertEqual(received, [f'm{i}' for i in range(10)])
+        self.assertEqual((closed['type'], closed['code']), ('websocket.close', SLOW_CONSUMER_CLOSE_CODE))
+
+    def test_metrics_endpoint_is_staff_only(self):
+        user = User.objects.create_user(username='alice')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('api_outbound_metrics')).status_code, 403)
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse('api_outbound_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('dropped_frames', response.json())
+
+
+@unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is needed for the binary protocol')
+class MsgpackProtocolTests(TransactionTestCase):
+    def test_binary_round_trip(self):
+        import msgpack
+        alice = User.objects.create_user(username='alice')
+        room = Room.objects.create(room_name='group_binary', room_type='group')
+        room.participants.add(alice)
+
+        async def chat():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/',
+                subprotocols=[MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL],
+            )
+            communicator.scope['user'] = alice
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+            await communicator.send_to(bytes_data=msgpack.packb({'m': 'hello', 'r': room.room_name}))
+            frame = msgpack.unpackb(await communicator.receive_from(5))
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(chat)()
+        self.assertEqual(frame['t'], EVENT_CODES['message'])
+        self.assertEqual((frame['s'], frame['m']), ('alice', 'hello'))
+        self.assertEqual(frame['i'], Message.objects.get().id)
+
+    def test_json_stays_the_default(self):
+        self.assertEqual(negotiate([]), (JSON_CODEC, None))
+        self.assertEqual(JSON_CODEC.encode('read', {'username': 'bob'}), '{"read": {"username": "bob"}}')
+
+    def test_msgpack_is_encoded_once_and_only_for_msgpack_recipients(self):
+        import msgpack
+        self.addCleanup(get_presence().drain)
+        users = [User.objects.create_user(username=name) for name in ('alice', 'bob', 'carol', 'dave')]
+        room = Room.objects.create(room_name='group_lazy', room_type='group')
+        room.participants.add(*users)
+        self.assertEqual(list(encode_frames('read', {'username': 'bob'})), ['json'])
+        _transcode.cache_clear()
+
+        async def chat():
+            sockets = {}
+            for user in users:
+                binary = user.username in ('carol', 'dave')
+                sockets[user.username] = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/',
+                    subprotocols=[MSGPACK_SUBPROTOCOL] if binary else [],
+                )
+                sockets[user.username].scope['user'] = user
+                await sockets[user.username].connect()
+            await sockets['alice'].send_json_to({'message': 'hello'})
+            frames = {}
+            for name in ('bob', 'carol', 'dave'):
+                while name not in frames:
+                    data = await sockets[name].receive_from(5)
+                    frame = json.loads(data) if isinstance(data, str) else msgpack.unpackb(data)
+                    if 'message' in frame or frame.get('t') == EVENT_CODES['message']:
+                        frames[name] = frame
+            for communicator in sockets.values():
+                await communicator.disconnect()
+            return frames
+
+        with mock.patch.object(MsgpackCodec, 'encode', autospec=True, side_effect=MsgpackCodec.encode) as encode:
+            frames = async_to_sync(chat)()
+        self.assertEqual(frames['bob']['message']['message'], 'hello')
+        self.assertEqual(frames['carol'], frames['dave'])
+        self.assertEqual(frames['carol']['m'], 'hello')
+        self.assertEqual([call.args[1] for call in encode.call_args_list].count('message'), 1)
+
+    def test_malformed_frames_get_an_error_frame(self):
+        import msgpack
+        self.addCleanup(get_presence().drain)
+        alice = User.objects.create_user(username='alice')
+        room = Room.objects.create(room_name='group_garbage', room_type='group')
+        room.participants.add(alice)
+
+        async def chat(subprotocols, garbage, decode):
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/', subprotocols=subprotocols,
+            )
+            communicator.scope['user'] = alice
+            await communicator.connect()
+            errors = []
+            for frame in garbage:
+                await communicator.send_to(**frame)
+                errors.append(decode(await communicator.receive_from(5)))
+            # The socket is still usable afterwards
+            await communicator.send_to(text_data=json.dumps({'message': 'still here'}))
+            after = decode(await communicator.receive_from(5))
+            await communicator.disconnect()
+            return errors, after
+
+        errors, after = async_to_sync(chat)([], [{'text_data': '{not json'}, {'text_data': '[1, 2]'}], json.loads)
+        self.assertEqual(errors, [{'error': {'error': 'malformed_frame'}}] * 2)
+        self.assertEqual(after['message']['message'], 'still here')
+        errors, after = async_to_sync(chat)(
+            [MSGPACK_SUBPROTOCOL], [{'bytes_data': b'\xc1'}, {'bytes_data': msgpack.packb([1])}], msgpack.unpackb,
+        )
+        self.assertEqual(errors, [{'t': EVENT_CODES['error'], 'e': 'malformed_frame'}] * 2)
+        self.assertEqual(after['m'], 'still here')
+
+
+CROSS_PROCESS_EVENTS = {'chat_message', 'typing_event', 'new_group_event'}
+
+
+def channel_layer_worker(hosts, username, room_group, ready, results):
+    # Runs in its own process and joins the same groups a ChatConsumer for
+    # `username` would, then reports which event types reached it
+    from channels_redis.core import RedisChannelLayer
+
+    async def run():
+        layer = RedisChannelLayer(hosts=hosts)
+        channel = await layer.new_channel()
+        await layer.group_add(room_group, channel)
+        await layer.group_add(f'user_{username}', channel)
+        ready.set()
+        received = set()
+        while not CROSS_PROCESS_EVENTS <= received:
+            event = await asyncio.wait_for(layer.receive(channel), 10)
+            received.add(event['type'])
+        results.put(username)
+
+    asyncio.run(run())
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('channels_redis') and importlib.util.find_spec('fakeredis'),
+    'channels_redis and fakeredis are needed for the cross-process channel layer test',
+)
+class CrossProcessChannelLayerTests(TransactionTestCase):
+    """
+    Fan-out from one process must reach sockets served by other worker processes.
+    Two local Redis-protocol servers stand in for a sharded Redis deployment.
+    """
+
+    def start_redis_server(self):
+        from fakeredis import TcpFakeServer
+        server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'redis://%s:%d/0' % server.server_address
+
+    def test_events_reach_other_worker_processes(self):
+        hosts = [self.start_redis_server(), self.start_redis_server()]
+        alice = User.objects.create_user(username='alice')
+        bob = User.objects.create_user(username='bob')
+        carol = User.objects.create_user(username='carol')
+        room = Room.objects.create(room_name='group_scaled', room_type='group')
+        room.participants.add(alice, bob, carol)
+
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        workers = []
+        for username in ('bob', 'carol'):
+            ready = ctx.Event()
+            worker = ctx.Process(
+                target=channel_layer_worker,
+                args=(hosts, username, f'room_{room.room_name}', ready, results),
+            )
+            worker.start()
+            self.addCleanup(worker.kill)
+            self.assertTrue(ready.wait(10))
+            workers.append(worker)
+
+        layers = {'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': hosts},
+        }}
+        with override_settings(CHANNEL_LAYERS=layers):
+            async def chat():
+                communicator = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/'
+                )
+                communicator.scope['user'] = alice
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                await communicator.send_json_to({'typing': 'start', 'room_name': room.room_name})
+                await communicator.send_json_to({'message': 'hello', 'room_name': room.room_name})
+                await communicator.receive_json_from(5)
+                await communicator.disconnect()
+
+            async_to_sync(chat)()
+            self.client.force_login(alice)
+            response = self.client.post(reverse('ajax_create_group_room'), {
+                'group_name': 'group_new',
+                'user_ids': f'{bob.id},{carol.id}',
+            })
+            self.assertEqual(response.status_code, 200)
+
+        delivered = {results.get(timeout=15) for _ in workers}
+        self.assertEqual(delivered, {'bob', 'carol'})
+        for worker in workers:
+            worker.join(5)
+
+
+class ReceiptTests(TransactionTestCase):
+    def test_status_never_moves_backwards(self):
+        alice = User.objects.create_user(username='alice')
+        room = Room.objects.create(room_name='group_receipts', room_type='group')
+        sent = Message.objects.create(room=room, sender=alice, message='same text')
+        read = Message.objects.create(room=room, sender=alice, message='same text', status='read')
+        self.assertEqual(advance_status([sent.id, read.id], 'delivered'), [sent.id])
+        self.assertEqual(
+            dict(Message.objects.values_list('id', 'status')),
+            {sent.id: 'delivered', read.id: 'read'},
+        )
+
+    def test_recipient_acknowledges_by_id(self):
+        alice = User.objects.create_user(username='alice')
+        bob = User.objects.create_user(username='bob')
+        room = Room.objects.create(room_name='group_receipts', room_type='group')
+        room.participants.add(alice, bob)
+
+        async def chat():
+            sockets = {}
+            for user in (alice, bob):
+                sockets[user.username] = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/'
+                )
+                sockets[user.username].scope['user'] = user
+                await sockets[user.username].connect()
+            for text in ('same text', 'same text'):
+                await sockets['alice'].send_json_to({'message': text, 'room_name': room.room_name})
+            frames = [await sockets['alice'].receive_json_from(5) for _ in range(3)]
+            # bob's client shows the messages and says so
+            await sockets['bob'].send_json_to({'read_ids': [frame['message']['id'] for frame in frames[:2]]})
+            frames.append(await sockets['alice'].receive_json_from(5))
+            await sockets['bob'].disconnect()
+            await sockets['alice'].disconnect()
+            return frames
+
+        frames = async_to_sync(chat)()
+        ids = [frame['message']['id'] for frame in frames[:2]]
+        # Sent to alice alone and not numbered as a room event
+        self.assertEqual(frames[2], {'receipt': {'status': 'delivered', 'ids': ids, 'room_name': room.room_name}})
+        self.assertEqual(frames[3], {'receipt': {'status': 'read', 'ids': ids, 'room_name': room.room_name}})
+        self.assertEqual(async_to_sync(get_replay_buffer().current)(room.room_name), frames[1]['message']['seq'])
+        self.assertEqual(set(Message.objects.values_list('status', flat=True)), {'read'})
+        membership = RoomMembership.objects.get(room=room, user=bob)
+        self.assertEqual((membership.last_delivered_message_id, membership.last_read_message_id), (ids[-1], ids[-1]))
+        # bob had the room open, so no unread badge is waiting for him on the dashboard
+        self.assertEqual(membership.unread_count, 0)
+
+    def test_opening_a_room_sends_read_receipts_by_id(self):
+        alice, bob, carol = [User.objects.create_user(username=name) for name in ('alice', 'bob', 'carol')]
+        room = Room.objects.create(room_name='group_opened', room_type='group')
+        room.participants.add(alice, bob, carol)
+        from_alice = Message.objects.create(room=room, sender=alice, message='one').id
+        from_carol = Message.objects.create(room=room, sender=carol, message='two').id
+        already_read = Message.objects.create(room=room, sender=alice, message='three', status='read').id
+
+        async def chat():
+            sockets = {}
+            for user in (alice, carol, bob):
+                sockets[user.username] = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/'
+                )
+                sockets[user.username].scope['user'] = user
+                await sockets[user.username].connect()
+            frames = {name: await sockets[name].receive_json_from(5) for name in ('alice', 'carol')}
+            for communicator in sockets.values():
+                await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(chat)()
+        # Each sender hears about their own messages only; rows already read are not repeated
+        self.assertEqual(frames['alice'], {'receipt': {'status': 'read', 'ids': [from_alice], 'room_name': room.room_name}})
+        self.assertEqual(frames['carol'], {'receipt': {'status': 'read', 'ids': [from_carol], 'room_name': room.room_name}})
+        self.assertEqual(Message.objects.get(id=already_read).status, 'read')
+
+
+class DeleteForSelfTests(TransactionTestCase):
+    def test_delete_for_me_over_the_socket(self):
+        self.addCleanup(get_presence().drain)
+        alice, bob, carol = [User.objects.create_user(username=name) for name in ('alice', 'bob', 'carol')]
+        room = Room.objects.create(room_name='group_delete', room_type='group')
+        room.participants.add(alice, bob)
+        other = Room.objects.create(room_name='group_other', room_type='group')
+        other.participants.add(alice, carol)
+        mine = Message.objects.create(room=room, sender=bob, message='hello')
+        elsewhere = Message.objects.create(room=other, sender=carol, message='hi')
+
+        async def delete(user, frames):
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/notification/{room.room_name}/'
+            )
+            communicator.scope['user'] = user
+            await communicator.connect()
+            replies = []
+            for frame in frames:
+                await communicator.send_json_to({**frame, 'delete_for': 'me'})
+                replies.append(await communicator.receive_json_from(5))
+            await communicator.disconnect()
+            return replies
+
+        replies = async_to_sync(delete)(alice, [
+            {'delete_message_id': 'tmp-abc-1'},
+            {'delete_message_id': elsewhere.id},
+            {'delete_message_id': str(mine.id)},
+        ])
+        self.assertEqual([reply.get('error', {}).get('error') for reply in replies[:2]], ['invalid_message'] * 2)
+        self.assertEqual(replies[2]['delete_message_id'], mine.id)
+        # Not a participant of the room, so not allowed to touch its messages
+        replies = async_to_sync(delete)(carol, [{'delete_message_id': mine.id}])
+        self.assertEqual(replies[0]['error']['error'], 'invalid_message')
+        self.assertEqual(list(MessageTombstone.objects.values_list('user__username', 'message_id')), [('alice', mine.id)])
+
+
+class ReceiptMigrationTests(TransactionTestCase):
+    migrate_from = [('ChatApp', '0007_message_indexes')]
+    migrate_to = [('ChatApp', '0008_receipt_high_water_marks')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_receipt_m2ms_become_marks_and_tombstones(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        apps = executor.loader.project_state(self.migrate_from).apps
+        User = apps.get_model('auth', 'User')
+        Room = apps.get_model('ChatApp', 'Room')
+        Message = apps.get_model('ChatApp', 'Message')
+        RoomMembership = apps.get_model('ChatApp', 'RoomMembership')
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        room = Room.objects.create(room_name='group_migrated', room_type='group')
+        for user in (alice, bob):
+            RoomMembership.objects.create(room=room, user=user)
+        first, second, third = [Message.objects.create(room=room, sender=alice, message=f'm{i}') for i in range(3)]
+        for message in (first, second, third):
+            message.delivered_to.add(bob)
+        for message in (first, second):
+            message.is_read.add(bob)
+        second.deleted_for.add(bob)
+        third.deleted_for.add(alice)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        apps = executor.loader.project_state(self.migrate_to).apps
+        marks = apps.get_model('ChatApp', 'RoomMembership').objects.values_list(
+            'user__username', 'last_delivered_message_id', 'last_read_message_id',
+        )
+        self.assertEqual(sorted(marks), [('alice', None, None), ('bob', third.id, second.id)])
+        tombstones = apps.get_model('ChatApp', 'MessageTombstone').objects.values_list(
+            'user__username', 'message_id', 'room_id',
+        )
+        self.assertEqual(sorted(tombstones), [('alice', third.id, room.id), ('bob', second.id, room.id)])
+
+
+class MultiplexConsumerTests(TransactionTestCase):
+    def setUp(self):
+        # Flush queued last_seen writes while the test database still exists
+        self.addCleanup(get_presence().drain)
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.first = Room.objects.create(room_name='group_first', room_type='group')
+        self.second = Room.objects.create(room_name='group_second', room_type='group')
+        self.closed = Room.objects.create(room_name='group_closed', room_type='group')
+        self.first.participants.add(self.alice, self.bob)
+        self.second.participants.add(self.alice, self.bob)
+        self.closed.participants.add(self.bob)
+
+    def socket(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_rooms_share_one_socket(self):
+        async def chat():
+            alice, bob = self.socket(self.alice), self.socket(self.bob)
+            await alice.connect()
+            await bob.connect()
+            await alice.send_json_to({'subscribe': ['group_first', 'group_second']})
+            frames = [await alice.receive_json_from(5) for _ in range(2)]
+            await bob.send_json_to({'subscribe': 'group_second'})
+            await bob.receive_json_from(5)
+            await bob.send_json_to({'message': 'hi', 'room_name': 'group_second'})
+            frames.append(await alice.receive_json_from(5))
+            await alice.send_json_to({'unsubscribe': 'group_second'})
+            frames.append(await alice.receive_json_from(5))
+            await bob.send_json_to({'message': 'gone', 'room_name': 'group_second'})
+            self.assertTrue(await alice.receive_nothing(0.2))
+            await bob.disconnect()
+            await alice.disconnect()
+            return frames
+
+        frames = async_to_sync(chat)()
+        self.assertEqual(
+            [frame['subscribed']['room_name'] for frame in frames[:2]], ['group_first', 'group_second'],
+        )
+        self.assertEqual((frames[2]['message']['message'], frames[2]['message']['room_name']), ('hi', 'group_second'))
+        self.assertEqual(frames[3], {'unsubscribed': {'room_name': 'group_second'}})
+        self.assertEqual(Message.objects.filter(room=self.second).count(), 2)
+
+    def test_non_participant_cannot_subscribe_or_send(self):
+        async def chat():
+            alice = self.socket(self.alice)
+            await alice.connect()
+            await alice.send_json_to({'subscribe': 'group_closed'})
+            refused = await alice.receive_json_from(5)
+            await alice.send_json_to({'message': 'sneaky', 'room_name': 'group_closed'})
+            rejected = await alice.receive_json_from(5)
+            await alice.disconnect()
+            return refused, rejected
+
+        refused, rejected = async_to_sync(chat)()
+        self.assertEqual(refused, {'error': {'room_name': 'group_closed', 'error': 'forbidden'}})
+        self.assertEqual(rejected, {'error': {'room_name': 'group_closed', 'error': 'not_subscribed'}})
+        self.assertFalse(Message.objects.exists())
+
+
+class ReplayTests(TransactionTestCase):
+    def setUp(self):
+        caches['chat_replay'].clear()
+        self.addCleanup(get_presence().drain)
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.room = Room.objects.create(room_name='group_replay', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+
+    def socket(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_ring_covers_only_the_last_size_events(self):
+        ring = RoomReplayBuffer('chat_replay', size=3, timeout=60)
+
+        async def fill():
+            return [await ring.append('r', lambda seq: {'seq': seq}) for _ in range(5)]
+
+        seqs = [event['seq'] for event in async_to_sync(fill)()]
+        events, current = async_to_sync(ring.since)('r', seqs[1])
+        self.assertEqual([event['seq'] for event in events], seqs[2:])
+        self.assertEqual(current, seqs[-1])
+        self.assertEqual(async_to_sync(ring.since)('r', seqs[-1]), ([], seqs[-1]))
+        # Four events missed, three kept
+        self.assertEqual(async_to_sync(ring.since)('r', seqs[0]), (None, seqs[-1]))
+
+    def test_reconnect_replays_missed_events(self):
+        async def chat():
+            alice, bob = self.socket(self.alice), self.socket(self.bob)
+            await alice.connect()
+            await alice.send_json_to({'subscribe': 'group_replay'})
+            last_seq = (await alice.receive_json_from(5))['subscribed']['seq']
+            await alice.disconnect()
+            await bob.connect()
+            await bob.send_json_to({'subscribe': 'group_replay'})
+            await bob.receive_json_from(5)
+            await bob.send_json_to({'message': 'while you were away', 'room_name': 'group_replay'})
+            sent = (await bob.receive_json_from(5))['message']
+            await bob.send_json_to({'delete_message_id': sent['id'], 'delete_for': 'everyone', 'room_name': 'group_replay'})
+            await bob.receive_json_from(5)
+            alice = self.socket(self.alice)
+            await alice.connect()
+            await alice.send_json_to({'subscribe': 'group_replay', 'last_seq': last_seq})
+            frames = [await alice.receive_json_from(5) for _ in range(3)]
+            # Nothing replayed is delivered twice
+            self.assertTrue(await alice.receive_nothing(0.2))
+            await alice.disconnect()
+            await bob.disconnect()
+            return last_seq, frames
+
+        last_seq, frames = async_to_sync(chat)()
+        # bob's message and the delete, in order
+        self.assertEqual(frames[0]['message']['message'], 'while you were away')
+        self.assertGreater(frames[0]['message']['seq'], last_seq)
+        self.assertEqual(frames[1]['delete_message_id'], frames[0]['message']['id'])
+        self.assertEqual(frames[2]['subscribed']['seq'], frames[1]['seq'])
+        # Replayed messages are acknowledged like live ones
+        self.assertEqual(Message.objects.get().status, 'read')
+
+    def test_gap_larger_than_ring_asks_for_resync(self):
+        async def chat():
+            alice = self.socket(self.alice)
+            await alice.connect()
+            await alice.send_json_to({'subscribe': 'group_replay', 'last_seq': 1})
+            frame = await alice.receive_json_from(5)
+            await alice.disconnect()
+            return frame
+
+        frame = async_to_sync(chat)()
+        self.assertEqual(frame['resync']['room_name'], 'group_replay')
+
+    def test_per_room_socket_replays_from_query_string(self):
+        async def chat():
+            bob = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notification/group_replay/')
+            bob.scope['user'] = self.bob
+            await bob.connect()
+            await bob.send_json_to({'message': 'hello', 'room_name': 'group_replay'})
+            seq = (await bob.receive_json_from(5))['message']['seq']
+            await bob.disconnect()
+            alice = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/notification/group_replay/?last_seq={seq - 1}',
+            )
+            alice.scope['user'] = self.alice
+            await alice.connect()
+            frame = await alice.receive_json_from(5)
+            await alice.disconnect()
+            return frame
+
+        frame = async_to_sync(chat)()
+        self.assertEqual(frame['message']['message'], 'hello')
+
+
+class RateLimitTests(TransactionTestCase):
+    def setUp(self):
+        get_buckets().clear()
+        self.addCleanup(get_buckets().clear)
+        self.addCleanup(get_presence().drain)
+
+    def test_bucket_allows_burst_then_waits(self):
+        buckets = MemoryBuckets(max_keys=10)
+        waits = [async_to_sync(buckets.take)('k', 1, 3) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertGreater(waits[3], 0.9)
+
+    def test_cache_buckets_are_shared(self):
+        cache.clear()
+        first, second = CacheBuckets('default'), CacheBuckets('default')
+        self.assertEqual(async_to_sync(first.take)('k', 0.1, 1), 0)
+        self.assertGreater(async_to_sync(second.take)('k', 0.1, 1), 0)
+
+    @override_settings(CHAT_RATE_LIMITS={'LIMITS': {'message': (0.1, 2)}})
+    def test_socket_gets_error_frame_when_over_quota(self):
+        alice = User.objects.create_user(username='alice')
+        room = Room.objects.create(room_name='group_limited', room_type='group')
+        room.participants.add(alice)
+
+        async def chat():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+            communicator.scope['user'] = alice
+            await communicator.connect()
+            await communicator.send_json_to({'subscribe': room.room_name})
+            await communicator.receive_json_from(5)
+            for text in ('one', 'two', 'three'):
+                await communicator.send_json_to({'message': text, 'room_name': room.room_name})
+            frames = [await communicator.receive_json_from(5) for _ in range(3)]
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(chat)()
+        error = frames[2]['error']
+        self.assertEqual((error['error'], error['action'], error['room_name']), ('rate_limited', 'message', room.room_name))
+        self.assertGreater(error['retry_after'], 0)
+        self.assertEqual(list(Message.objects.values_list('message', flat=True)), ['one', 'two'])
+
+    @override_settings(CHAT_RATE_LIMITS={'LIMITS': {'create_room': (0.01, 1)}})
+    def test_room_creation_is_limited(self):
+        alice = User.objects.create_user(username='alice')
+        bob = User.objects.create_user(username='bob')
+        self.client.force_login(alice)
+        response = self.client.post(reverse('ajax_create_private_room'), {'other_username': 'bob'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('ajax_create_group_room'), {'group_name': 'g', 'user_ids': str(bob.id)})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '100')
+        self.assertFalse(Room.objects.filter(room_name='g').exists())
+
+
+class PresenceSubscriptionTests(TransactionTestCase):
+    def test_subscriber_gets_snapshot_then_changes(self):
+        cache.clear()
+        self.addCleanup(get_presence().drain)
+        alice = User.objects.create_user(username='alice')
+        bob = User.objects.create_user(username='bob')
+
+        async def watch():
+            watcher = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notification/global/')
+            watcher.scope['user'] = alice
+            await watcher.connect()
+            await watcher.send_json_to({'subscribe_presence': ['bob', 'nobody']})
+            frames = [await watcher.receive_json_from(5)]
+            bob_socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notification/global/')
+            bob_socket.scope['user'] = bob
+            await bob_socket.connect()
+            frames.append(await watcher.receive_json_from(5))
+            await bob_socket.disconnect()
+            frames.append(await watcher.receive_json_from(5))
+            await watcher.send_json_to({'unsubscribe_presence': ['bob']})
+            bob_socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notification/global/')
+            bob_socket.scope['user'] = bob
+            await bob_socket.connect()
+            self.assertTrue(await watcher.receive_nothing(0.2))
+            await bob_socket.disconnect()
+            await watcher.disconnect()
+            return frames
+
+        with mock.patch.object(get_presence(), 'offline_grace', 0):
+            frames = async_to_sync(watch)()
+        self.assertEqual(frames[0], {'presence': {'users': [{'username': 'bob', 'status': 'offline', 'last_seen': None}]}})
+        self.assertEqual(frames[1]['presence']['users'][0]['status'], 'online')
+        offline = frames[2]['presence']['users'][0]
+        self.assertEqual(offline['status'], 'offline')
+        self.assertIsNotNone(offline['last_seen'])
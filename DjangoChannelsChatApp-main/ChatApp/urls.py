@@ -14,4 +14,6 @@ urlpatterns = [
     path('ajax_delete_private_room/', views.ajax_delete_private_room, name='ajax_delete_private_room'),
     path('ajax_delete_group_room/', views.ajax_delete_group_room, name='ajax_delete_group_room'),
     path('chat/api/messages/<str:room_name>/', views.api_get_messages, name='api_get_messages'),
+    path('chat/api/messages/<str:room_name>/export/', views.api_export_messages, name='api_export_messages'),
+    path('chat/api/metrics/outbound/', views.api_outbound_metrics, name='api_outbound_metrics'),
 ]
\ No newline at end of file
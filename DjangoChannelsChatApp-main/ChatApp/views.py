@@ -1,45 +1,78 @@
+import math
+
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from .models import Room, Message
+from .models import Room, Message, RoomMembership
+from accounts.presence import get_presence
+from accounts.ws_auth import issue_ticket
+from .protocol import encode_frames
+from .history import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, afetch_message_page, decode_cursor
+from .history_cache import get_history_cache
+from .export import EXPORT_FORMATS, aexport_lines, export_lines
+from .fanout import send_in_background, send_to_groups
+from .outbound import get_outbound_metrics
+from .ratelimit import check_rate
+from django.db.models import F, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from django.views.decorators.http import require_POST
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
 from channels.layers import get_channel_layer
 
+def annotate_room_info(rooms, user):
+    # Last message and unread count are denormalized (Room.last_message, RoomMembership),
+    # so this is a join plus a unique-key lookup per room, most recently active first
+    membership = RoomMembership.objects.filter(room=OuterRef('pk'), user=user)
+    return rooms.select_related('last_message').annotate(
+        unread_count=Coalesce(Subquery(membership.values('unread_count')[:1]), 0),
+    ).order_by(F('last_activity').desc(nulls_last=True), 'id')
+
+
+def rate_limited_response(retry_after):
+    response = JsonResponse({'error': 'Too many requests.', 'retry_after': round(retry_after, 2)}, status=429)
+    response['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
 @login_required(login_url='/accounts/login/')
-def dashboard(request):
-    user = request.user
-    private_rooms = Room.objects.filter(participants=user, room_type='private')
-    group_rooms = Room.objects.filter(participants=user, room_type='group')
-    available_groups = Room.objects.filter(room_type='group').exclude(participants=user)
+async def dashboard(request):
+    user = await request.auser()
+    # The template is rendered from plain lists, so nothing touches the database while rendering
+    request.user = user
+    private_rooms = [room async for room in annotate_room_info(
+        Room.objects.filter(participants=user, room_type='private'), user
+    ).prefetch_related(
+        Prefetch('participants', queryset=User.objects.all())
+    )]
+    group_rooms = [room async for room in annotate_room_info(Room.objects.filter(participants=user, room_type='group'), user)]
+    available_groups = [room async for room in annotate_room_info(
+        Room.objects.filter(room_type='group').exclude(participants=user), user
+    )]
+
+    # Live online state comes from the presence tracker, one cache read for all contacts
+    online = await get_presence().aonline_map(
+        {u.id for room in private_rooms for u in room.participants.all() if u.id != user.id}
+    )
 
     def get_room_info(room):
-        latest_message = Message.objects.filter(room=room).order_by('-timestamp').first()
-        if latest_message:
-            last_message = latest_message.message
-            last_timestamp = latest_message.timestamp
-        else:
-            last_message = None
-            last_timestamp = None
-        unread_count = Message.objects.filter(room=room).exclude(is_read=user).count()
         # For private rooms, get the other participant's online status and superuser status
         online_status = None
         is_superuser = False
         if room.room_type == 'private':
-            other_users = room.participants.exclude(id=user.id)
-            if other_users.exists():
-                from accounts.models import Profile
-                profile = Profile.objects.filter(user=other_users.first()).first()
-                online_status = profile.is_online if profile else False
-                is_superuser = other_users.first().is_superuser
+            other_users = [u for u in room.participants.all() if u.id != user.id]
+            if other_users:
+                other_user = other_users[0]
+                online_status = online[other_user.id]
+                is_superuser = other_user.is_superuser
         return {
             'room': room,
-            'last_message': last_message,
-            'last_timestamp': last_timestamp,
-            'unread_count': unread_count,
+            'last_message': room.last_message.message if room.last_message else None,
+            'last_timestamp': room.last_activity,
+            'unread_count': room.unread_count,
             'online_status': online_status,
             'is_superuser': is_superuser,
         }
@@ -47,40 +80,50 @@ def dashboard(request):
     private_rooms_info = [get_room_info(room) for room in private_rooms]
     group_rooms_info = [get_room_info(room) for room in group_rooms]
     available_groups_info = [get_room_info(room) for room in available_groups]
-    users = User.objects.exclude(id=request.user.id)
+    users = [u async for u in User.objects.exclude(id=user.id)]
     return render(request, 'dashboard.html', {
         'private_rooms_info': private_rooms_info,
         'group_rooms_info': group_rooms_info,
         'available_groups_info': available_groups_info,
         'user': user,
         'users': users,
+        # Lets the socket connect without a session lookup
+        'ws_ticket': issue_ticket(user),
     })
 
 @csrf_exempt
 @login_required(login_url='/accounts/login/')
-def ajax_create_private_room(request):
+async def ajax_create_private_room(request):
     if request.method == 'POST':
+        user = await request.auser()
+        retry_after = await check_rate('create_room', user.id)
+        if retry_after:
+            return rate_limited_response(retry_after)
         other_username = request.POST.get('other_username', '').strip().lower()
-        if not other_username or other_username == request.user.username.lower():
+        if not other_username or other_username == user.username.lower():
             return JsonResponse({'error': 'You cannot chat with yourself.'}, status=400)
         try:
-            other_user = User.objects.get(username__iexact=other_username)
+            other_user = await User.objects.aget(username__iexact=other_username)
         except User.DoesNotExist:
             return JsonResponse({'error': f"User '{other_username}' not found."}, status=404)
-        private_rooms = Room.objects.filter(room_type='private', participants=request.user).filter(participants=other_user)
-        for room in private_rooms:
-            if room.participants.count() == 2:
+        private_rooms = Room.objects.filter(room_type='private', participants=user).filter(participants=other_user)
+        async for room in private_rooms:
+            if await room.participants.acount() == 2:
                 return JsonResponse({'room_name': room.room_name, 'status': 'exists'})
-        room_name = f"private_{min(request.user.id, other_user.id)}_{max(request.user.id, other_user.id)}"
-        room, created = Room.objects.get_or_create(room_name=room_name, room_type='private')
-        room.participants.set([request.user, other_user])
+        room_name = f"private_{min(user.id, other_user.id)}_{max(user.id, other_user.id)}"
+        room, created = await Room.objects.aget_or_create(room_name=room_name, room_type='private')
+        await room.participants.aset([user, other_user])
         return JsonResponse({'room_name': room.room_name, 'status': 'created'})
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
 @csrf_exempt
 @login_required(login_url='/accounts/login/')
-def ajax_create_group_room(request):
+async def ajax_create_group_room(request):
     if request.method == 'POST':
+        user = await request.auser()
+        retry_after = await check_rate('create_room', user.id)
+        if retry_after:
+            return rate_limited_response(retry_after)
         group_name = request.POST.get('group_name', '').strip()
         # Robustly parse user_ids (handle both list and comma-separated string)
         user_ids = request.POST.getlist('user_ids[]')
@@ -90,93 +133,134 @@ def ajax_create_group_room(request):
                 user_ids = user_ids_str.split(',')
         if not group_name:
             return JsonResponse({'error': 'Group name required.'}, status=400)
-        if Room.objects.filter(room_name=group_name, room_type='group').exists():
+        if await Room.objects.filter(room_name=group_name, room_type='group').aexists():
             return JsonResponse({'error': 'Group name already exists.'}, status=400)
-        room = Room.objects.create(room_name=group_name, room_type='group')
-        room.participants.add(request.user)
-        users = User.objects.filter(id__in=user_ids)
-        for u in users:
-            room.participants.add(u)
-        # Notify new group members in real time
-        channel_layer = get_channel_layer()
-        group_info = {
+        room = await Room.objects.acreate(room_name=group_name, room_type='group')
+        members = {
+            member_id: username
+            async for member_id, username in User.objects.filter(
+                id__in=[uid for uid in user_ids if str(uid).strip().isdigit()]
+            ).exclude(id=user.id).values_list('id', 'username')
+        }
+        # One bulk insert into the through table (and one m2m_changed for the memberships)
+        await room.participants.aadd(user.id, *members)
+        usernames = [user.username, *members.values()]
+        # Notify new group members in real time; encoded once and sent concurrently
+        frames = encode_frames('new_group', {
             'room_name': room.room_name,
             'room_type': room.room_type,
-            'participants': [u.username for u in room.participants.all()],
-        }
-        for u in users:
-            print(f"[DEBUG] Sending new_group_event to user_{u.username}")
-            async_to_sync(channel_layer.group_send)(
-                f'user_{u.username}',
-                {
-                    'type': 'new_group_event',
-                    'group_info': group_info,
-                }
-            )
-        # Also notify the creator
-        print(f"[DEBUG] Sending new_group_event to user_{request.user.username}")
-        async_to_sync(channel_layer.group_send)(
-            f'user_{request.user.username}',
-            {
-                'type': 'new_group_event',
-                'group_info': group_info,
-            }
+            'participants': usernames,
+        })
+        fan_out = send_to_groups(
+            get_channel_layer(),
+            [f'user_{username}' for username in usernames],
+            {'type': 'new_group_event', 'frames': frames},
         )
+        if isinstance(request, ASGIRequest):
+            # The room and memberships are committed; respond without waiting on the channel layer
+            send_in_background(fan_out)
+        else:
+            # Under WSGI the request's event loop closes with the response, so finish first
+            await fan_out
         return JsonResponse({'room_name': room.room_name, 'status': 'created'})
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
 @require_GET
 @login_required(login_url='/accounts/login/')
-def api_get_messages(request, room_name):
+async def api_get_messages(request, room_name):
+    try:
+        room = await Room.objects.aget(room_name=room_name)
+    except Room.DoesNotExist:
+        return JsonResponse({'error': 'Room not found'}, status=404)
+    # Keyset pagination by (timestamp, id):
+    #   ?before=<cursor>  older page, ?after=<cursor>  newer page,
+    #   ?since=<message id>  everything after a message the client already has (reconnect delta),
+    #   ?limit=<n>  page size. With no cursor the newest page is returned.
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        before = decode_cursor(request.GET['before']) if request.GET.get('before') else None
+        after = decode_cursor(request.GET['after']) if request.GET.get('after') else None
+        since = int(request.GET['since']) if request.GET.get('since') else None
+    except (ValueError, InvalidCursor):
+        return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+    if since is not None:
+        since_msg = await Message.objects.filter(room=room, id=since).values('timestamp', 'id').afirst()
+        if since_msg is None:
+            return JsonResponse({'error': 'Message not found'}, status=404)
+        after = (since_msg['timestamp'], since_msg['id'])
+    user = await request.auser()
+    # Recent windows come from the per-room cache; anything older goes to the database
+    page = await sync_to_async(get_history_cache().get_page)(room, user, before=before, after=after, limit=limit)
+    if page is None:
+        page = await afetch_message_page(room, user, before=before, after=after, limit=limit)
+    return JsonResponse({
+        'messages': page['messages'],
+        'room_type': room.room_type,
+        'room_name': room.room_name,
+        'has_more': page['has_more'],
+        'cursors': {'before': page['before'], 'after': page['after']},
+    })
+
+@require_GET
+@login_required(login_url='/accounts/login/')
+def api_export_messages(request, room_name):
+    # Full room history for compliance pulls: ?format=ndjson (default) or ?format=csv.
+    # Rows are streamed as they are read, so old rooms neither time out nor fill memory.
     try:
         room = Room.objects.get(room_name=room_name)
     except Room.DoesNotExist:
         return JsonResponse({'error': 'Room not found'}, status=404)
-    messages_qs = Message.objects.filter(room=room).order_by('timestamp').exclude(deleted_for=request.user)
-    messages_list = []
-    for msg in messages_qs:
-        messages_list.append({
-            'id': msg.id,
-            'sender': msg.sender.username,
-            'sender_id': msg.sender.id,
-            'message': msg.message,
-            'timestamp': msg.timestamp.isoformat(),
-            'is_self': msg.sender == request.user,
-            'media_url': msg.media.url if msg.media else None,
-            'status': msg.status,
-        })
-    return JsonResponse({'messages': messages_list, 'room_type': room.room_type, 'room_name': room.room_name})
+    if not request.user.is_staff and not room.participants.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'You are not a participant of this chat.'}, status=403)
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Unsupported export format'}, status=400)
+    if isinstance(request, ASGIRequest):
+        lines = aexport_lines(room, export_format)
+    else:
+        lines = export_lines(room, export_format)
+    response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{room.room_name}.{export_format}"'
+    return response
+
+@require_GET
+@login_required(login_url='/accounts/login/')
+def api_outbound_metrics(request):
+    # WebSocket outbound queue depth, drops and slow-consumer disconnects for this process
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only.'}, status=403)
+    return JsonResponse(get_outbound_metrics().snapshot())
 
 @csrf_exempt
 @login_required(login_url='/accounts/login/')
-def ajax_delete_private_room(request):
+async def ajax_delete_private_room(request):
     if request.method == 'POST':
         room_name = request.POST.get('room_name', '').strip()
-        user = request.user
+        user = await request.auser()
         try:
-            room = Room.objects.get(room_name=room_name, room_type='private')
+            room = await Room.objects.aget(room_name=room_name, room_type='private')
         except Room.DoesNotExist:
             return JsonResponse({'error': 'Room not found.'}, status=404)
-        if user not in room.participants.all():
+        if not await room.participants.filter(id=user.id).aexists():
             return JsonResponse({'error': 'You are not a participant of this chat.'}, status=403)
         # Delete the room (and cascade delete messages)
-        room.delete()
+        await room.adelete()
         return JsonResponse({'status': 'deleted'})
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
 @csrf_exempt
 @login_required(login_url='/accounts/login/')
-def ajax_delete_group_room(request):
+async def ajax_delete_group_room(request):
     if request.method == 'POST':
         room_name = request.POST.get('room_name', '').strip()
-        user = request.user
+        user = await request.auser()
         try:
-            room = Room.objects.get(room_name=room_name, room_type='group')
+            room = await Room.objects.aget(room_name=room_name, room_type='group')
         except Room.DoesNotExist:
             return JsonResponse({'error': 'Group not found.'}, status=404)
-        if user not in room.participants.all():
+        if not await room.participants.filter(id=user.id).aexists():
             return JsonResponse({'error': 'You are not a participant of this group.'}, status=403)
         # Optionally: Only allow group creator to delete. For now, allow any participant.
-        room.delete()
+        await room.adelete()
         return JsonResponse({'status': 'deleted'})
     return JsonResponse({'error': 'Invalid request'}, status=400)
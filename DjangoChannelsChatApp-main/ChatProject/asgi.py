@@ -11,16 +11,20 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack # Import AuthMiddlewareStack
-from ChatApp import routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatProject.settings')
 
 django_asgi_app = get_asgi_application()
 
+# Imported after Django is set up
+from accounts.ws_auth import TicketAuthMiddleware
+from ChatApp import routing
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack( # Wrap your WebSocket URLRouter with AuthMiddlewareStack
+    # Signed tickets and JWT access tokens are checked without the database;
+    # sockets without either fall back to session auth
+    "websocket": TicketAuthMiddleware(
         URLRouter(
             routing.websocket_urlpatterns
         )
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -97,10 +98,116 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'ChatProject.wsgi.application'
 ASGI_APPLICATION = "ChatProject.asgi.application"
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Channel layer. Set CHANNEL_REDIS_HOSTS to a comma separated list of redis:// URLs
+# to run several Daphne workers; channels_redis shards channels and groups across
+# the hosts. Without it a single-process in-memory layer is used.
+CHANNEL_REDIS_HOSTS = [host.strip() for host in os.environ.get('CHANNEL_REDIS_HOSTS', '').split(',') if host.strip()]
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_HOSTS,
+                "prefix": os.environ.get('CHANNEL_REDIS_PREFIX', 'asgi'),
+                "capacity": int(os.environ.get('CHANNEL_LAYER_CAPACITY', '1500')),
+                "expiry": 60,
+            },
+        }
     }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Recent history per room (ChatApp/history_cache.py). LocMem culls the least
+    # recently used entries once MAX_ENTRIES is reached; use a shared backend
+    # (e.g. Redis with maxmemory-policy allkeys-lru) when running several workers.
+    'chat_history': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-history',
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+    # Per-room event rings for reconnect replay (ChatApp/replay.py); shared backend
+    # when running several workers, same as above
+    'chat_replay': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-replay',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Presence tracking (accounts/presence.py). Online state lives in the CACHE alias;
+# point it at a shared cache when running several workers.
+CHAT_PRESENCE = {
+    'CACHE': 'default',
+    'OFFLINE_GRACE': 5,
+    'FLUSH_INTERVAL': 10,
+}
+
+# Server-side typing indicator coalescing (ChatApp/indicators.py)
+CHAT_TYPING = {
+    'INTERVAL': 1.0,
+    'EXPIRY': 6.0,
+}
+
+# Delivery and read receipts are batched per connection (ChatApp/receipts.py)
+CHAT_RECEIPTS = {
+    'MAX_BATCH_SIZE': 100,
+    'MAX_DELAY': 0.25,
+}
+
+# Per-connection outbound queues (ChatApp/outbound.py). Typing frames are shed
+# first, then receipts are merged; at MAX_FRAMES the socket is closed with 4008
+CHAT_OUTBOUND = {
+    'MAX_FRAMES': 1000,
+    'SHED_TYPING_AT': 100,
+    'COALESCE_RECEIPTS_AT': 200,
+}
+
+# Token-bucket limits on WebSocket sends, typing, deletes and room creation
+# (ChatApp/ratelimit.py), as (tokens per second, burst). CACHE None keeps the
+# buckets per process; name a shared cache alias to enforce them across workers.
+CHAT_RATE_LIMITS = {
+    'ENABLED': True,
+    'CACHE': None,
+    'LIMITS': {
+        'message': (2, 20),
+        'room_message': (20, 100),
+        'typing': (5, 20),
+        'delete': (1, 10),
+        'create_room': (0.1, 10),
+    },
+}
+
+# Write-behind batching for chat messages sent over WebSocket (ChatApp/buffer.py).
+# When enabled, messages are broadcast with a provisional id and bulk inserted
+# once MAX_BATCH_SIZE are waiting or after MAX_FLUSH_DELAY seconds.
+# Provisional ids are not swapped for real ones, so clients cannot delete or
+# acknowledge those messages until they reload the room history.
+CHAT_MESSAGE_BUFFER = {
+    'ENABLED': False,
+    'MAX_BATCH_SIZE': 200,
+    'MAX_FLUSH_DELAY': 0.05,
+}
+
+# The last SIZE events per room are replayed to clients that reconnect
+CHAT_REPLAY = {
+    'CACHE': 'chat_replay',
+    'SIZE': 500,
+    'TIMEOUT': 3600,
+}
+
+# Newest SIZE messages per room are served from the chat_history cache
+CHAT_HISTORY_CACHE = {
+    'CACHE': 'chat_history',
+    'SIZE': 200,
+    'TIMEOUT': 3600,
 }
 
 
@@ -1,32 +1,133 @@
 from rest_framework import viewsets, permissions, generics
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth.models import User
+from django.db.models import Prefetch
 from accounts.models import Profile
+from accounts.presence import get_presence
+from accounts.ws_auth import get_ws_auth_settings, issue_ticket
 from ChatApp.models import Room, Message
-from .serializers import UserSerializer, ProfileSerializer, RoomSerializer, MessageSerializer, RegisterSerializer
+from .serializers import (
+    UserSerializer, ProfileSerializer, RoomSerializer, MessageSerializer, MessageLightSerializer, RegisterSerializer,
+    message_data, message_light_data, room_data, user_data,
+)
 from rest_framework.views import APIView
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+class FastReadMixin:
+    """
+    Serve list and retrieve with a plain function (`read_serializer`) that builds
+    the same dicts as the ModelSerializer, which stays in charge of writes.
+    """
+    read_serializer = None
+
+    def get_read_serializer(self):
+        return self.read_serializer
+
+    def list(self, request, *args, **kwargs):
+        to_data = self.get_read_serializer()
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response([to_data(obj) for obj in page])
+        return Response([to_data(obj) for obj in queryset])
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.get_read_serializer()(self.get_object()))
+
+
+class UserViewSet(FastReadMixin, viewsets.ReadOnlyModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
+    read_serializer = staticmethod(user_data)
+
+    def list(self, request, *args, **kwargs):
+        # Unpaginated: skip model instances altogether
+        return Response(list(self.filter_queryset(self.get_queryset()).values('id', 'username')))
 
 class ProfileViewSet(viewsets.ModelViewSet):
     queryset = Profile.objects.all()
     serializer_class = ProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-class RoomViewSet(viewsets.ModelViewSet):
-    queryset = Room.objects.all()
+class RoomCursorPagination(CursorPagination):
+    ordering = '-id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class MessageCursorPagination(CursorPagination):
+    # Newest first. Filtered to one room (?room or ?room_name) this walks the
+    # (room, timestamp, id) index; an unfiltered listing has no index in this
+    # order and sorts every message before serving the first page.
+    ordering = ('-timestamp', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class RoomViewSet(FastReadMixin, viewsets.ModelViewSet):
+    queryset = Room.objects.prefetch_related(Prefetch('participants', queryset=User.objects.only('id', 'username')))
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = RoomCursorPagination
+    read_serializer = staticmethod(room_data)
 
-class MessageViewSet(viewsets.ModelViewSet):
+
+class MessageViewSet(FastReadMixin, viewsets.ModelViewSet):
+    """
+    Filters: ?room=<id>, ?room_name=<name>, ?since=<ISO datetime>, ?until=<ISO datetime>.
+    ?view=light returns flat room_id/sender_id rows without nested objects.
+    """
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
+
+    def is_light(self):
+        return self.request.query_params.get('view') == 'light'
+
+    def get_serializer_class(self):
+        if self.is_light():
+            return MessageLightSerializer
+        return MessageSerializer
+
+    def get_read_serializer(self):
+        return message_light_data if self.is_light() else message_data
+
+    def get_queryset(self):
+        queryset = Message.objects.all()
+        if self.is_light():
+            queryset = queryset.only('id', 'room_id', 'sender_id', 'message', 'timestamp', 'status')
+        else:
+            queryset = queryset.select_related('room', 'sender').prefetch_related(
+                Prefetch('room__participants', queryset=User.objects.only('id', 'username'))
+            )
+        params = self.request.query_params
+        if params.get('room'):
+            try:
+                queryset = queryset.filter(room_id=int(params['room']))
+            except ValueError:
+                raise ValidationError({'room': 'Expected a room id.'})
+        if params.get('room_name'):
+            queryset = queryset.filter(room__room_name=params['room_name'])
+        for param, lookup in (('since', 'timestamp__gte'), ('until', 'timestamp__lt')):
+            if params.get(param):
+                try:
+                    value = parse_datetime(params[param])
+                except ValueError:
+                    value = None
+                if value is None:
+                    raise ValidationError({param: 'Expected an ISO 8601 datetime.'})
+                if timezone.is_naive(value):
+                    value = timezone.make_aware(value)
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
 
 class RegisterAPIView(generics.CreateAPIView):
     serializer_class = RegisterSerializer
@@ -40,19 +141,86 @@ class RegisterAPIView(generics.CreateAPIView):
             "user": UserSerializer(user, context=self.get_serializer_context()).data,
         }, status=status.HTTP_201_CREATED)
 
+class WebSocketTicketAPIView(APIView):
+    # POST: a signed, short-lived ticket for ?ticket= on the chat socket
+    def post(self, request):
+        return Response({
+            'ticket': issue_ticket(request.user),
+            'expires_in': get_ws_auth_settings()['TICKET_MAX_AGE'],
+        })
+
 class UserStatusAPIView(APIView):
     def get(self, request, username):
         try:
             profile = Profile.objects.get(user__username=username)
-            if profile.is_online:
+            presence = get_presence()
+            last_seen = presence.last_seen(profile.user_id) or profile.last_seen
+            if presence.is_online(profile.user_id):
                 return Response({"status": "Online", "last_seen": None})
-            elif profile.last_seen:
-                return Response({"status": "Offline", "last_seen": profile.last_seen.strftime('%Y-%m-%d %H:%M:%S')})
+            elif last_seen:
+                return Response({"status": "Offline", "last_seen": last_seen.strftime('%Y-%m-%d %H:%M:%S')})
             else:
                 return Response({"status": "Offline", "last_seen": None})
         except Profile.DoesNotExist:
             return Response({"status": "Unknown user", "last_seen": None}, status=404)
 
+# Batch lookups answer at most this many usernames or ids per request
+MAX_BATCH_LOOKUP = 500
+
+
+def batch_param(request, name):
+    """Comma separated values from ?<name>=a,b,c (repeatable) or a JSON list in the request body."""
+    if request.method == 'POST':
+        values = request.data.get(name, [])
+        if not isinstance(values, list):
+            raise ValidationError({name: 'Expected a list.'})
+    else:
+        values = [v for param in request.query_params.getlist(name) for v in param.split(',')]
+    values = list(dict.fromkeys(str(v).strip() for v in values if str(v).strip()))
+    if not values:
+        raise ValidationError({name: 'This parameter is required.'})
+    if len(values) > MAX_BATCH_LOOKUP:
+        raise ValidationError({name: f'At most {MAX_BATCH_LOOKUP} values per request.'})
+    return values
+
+
+class UserStatusBatchAPIView(APIView):
+    # GET ?usernames=alice,bob or POST {"usernames": [...]}; same per-user shape as UserStatusAPIView
+    def get(self, request):
+        usernames = batch_param(request, 'usernames')
+        # Users without a profile are unknown, as in UserStatusAPIView
+        snapshot = get_presence().snapshot(usernames, with_profile=True)
+        statuses = {}
+        for username in usernames:
+            if username not in snapshot:
+                statuses[username] = {"status": "Unknown user", "last_seen": None}
+                continue
+            _, online, last_seen = snapshot[username]
+            if online:
+                statuses[username] = {"status": "Online", "last_seen": None}
+            else:
+                statuses[username] = {
+                    "status": "Offline",
+                    "last_seen": last_seen.strftime('%Y-%m-%d %H:%M:%S') if last_seen else None,
+                }
+        return Response(statuses)
+
+    post = get
+
+
+class MessageStatusBatchAPIView(APIView):
+    # GET ?ids=1,2,3 or POST {"ids": [...]}; one query for the whole list
+    def get(self, request):
+        try:
+            ids = [int(value) for value in batch_param(request, 'ids')]
+        except ValueError:
+            raise ValidationError({'ids': 'Expected message ids.'})
+        found = dict(Message.objects.filter(id__in=ids).values_list('id', 'status'))
+        return Response({str(message_id): found.get(message_id, "Unknown message") for message_id in ids})
+
+    post = get
+
+
 class MessageStatusAPIView(APIView):
     def get(self, request, message_id):
         try:
@@ -0,0 +1,261 @@
+# accounts/presence.py
+
+import asyncio
+import atexit
+import logging
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_DEFAULTS = {
+    'CACHE': 'default',        # use a shared cache (Redis, Memcached) when running several workers
+    'OFFLINE_GRACE': 5,        # seconds without any socket before a user counts as offline
+    'FLUSH_INTERVAL': 10,      # seconds between batched is_online/last_seen writes to Profile
+    'CONNECTION_TTL': 86400,   # connection counts expire in case a worker dies without cleaning up;
+                               # live sockets keep refreshing them
+}
+
+
+def get_presence_settings():
+    return {**PRESENCE_DEFAULTS, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+class PresenceTracker:
+    """
+    Online state kept in the cache instead of the Profile table.
+
+    Every socket a user opens increments a connection count and every close
+    decrements it, so a tab with several sockets is one online user. A user only
+    goes offline once the count has stayed at zero for OFFLINE_GRACE seconds,
+    which absorbs page refreshes and room switches. Offline transitions record
+    last_seen in the cache straight away. Both transitions are written to
+    Profile.is_online and Profile.last_seen in batches every FLUSH_INTERVAL
+    seconds, and sent to the presence_<user id> channel group for sockets that
+    subscribed to the user.
+
+    Counts expire after CONNECTION_TTL so a dead worker cannot keep users online
+    forever. Each worker refreshes the counts of the sockets it holds every third
+    of that, and puts its share back if a count was evicted underneath them.
+    """
+
+    def __init__(self, cache_alias, offline_grace, flush_interval, connection_ttl):
+        self.cache_alias = cache_alias
+        self.offline_grace = offline_grace
+        self.flush_interval = flush_interval
+        self.connection_ttl = connection_ttl
+        self._pending = {}      # user id -> last_seen, or None for an online transition
+        self._local = Counter()  # sockets held by this process, per user id
+        self._flush_timer = None
+        self._heartbeat = None
+        self._tasks = set()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def connections_key(self, user_id):
+        return f'presence:connections:{user_id}'
+
+    def seen_key(self, user_id):
+        return f'presence:seen:{user_id}'
+
+    def group_name(self, user_id):
+        return f'presence_{user_id}'
+
+    async def connect(self, user_id):
+        key = self.connections_key(user_id)
+        self._local[user_id] += 1
+        self._start_heartbeat()
+        await self.cache.aadd(key, 0, self.connection_ttl)
+        count = await self.cache.aincr(key)
+        # incr keeps the expiry set by add, so push it out again
+        await self.cache.atouch(key, self.connection_ttl)
+        if count == 1:
+            await self._record(user_id, None)
+            await self._publish(user_id, True, None)
+
+    async def disconnect(self, user_id):
+        key = self.connections_key(user_id)
+        self._local[user_id] -= 1
+        if self._local[user_id] <= 0:
+            del self._local[user_id]
+        if not self._local and self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        try:
+            remaining = await self.cache.adecr(key)
+        except ValueError:
+            # The count expired or was evicted; only sockets held here are known
+            remaining = self._local[user_id]
+            if remaining:
+                await self._restore(user_id, remaining)
+        if remaining > 0:
+            return
+        if self.offline_grace:
+            self._spawn(self._offline_after_grace(user_id))
+        else:
+            await self._go_offline(user_id)
+
+    def is_online(self, user_id):
+        return (self.cache.get(self.connections_key(user_id)) or 0) > 0
+
+    def online_map(self, user_ids):
+        # One cache round trip for any number of users
+        keys = {self.connections_key(user_id): user_id for user_id in user_ids}
+        counts = self.cache.get_many(keys)
+        return {user_id: (counts.get(key) or 0) > 0 for key, user_id in keys.items()}
+
+    async def aonline_map(self, user_ids):
+        keys = {self.connections_key(user_id): user_id for user_id in user_ids}
+        counts = await self.cache.aget_many(keys)
+        return {user_id: (counts.get(key) or 0) > 0 for key, user_id in keys.items()}
+
+    def last_seen(self, user_id):
+        # Cached value first; Profile may lag behind by up to FLUSH_INTERVAL
+        return self.cache.get(self.seen_key(user_id))
+
+    def last_seen_map(self, user_ids):
+        keys = {self.seen_key(user_id): user_id for user_id in user_ids}
+        seen = self.cache.get_many(keys)
+        return {user_id: seen.get(key) for key, user_id in keys.items()}
+
+    def snapshot(self, usernames, with_profile=False):
+        """
+        {username: (user id, online, last_seen)} for every known username: one
+        query plus two cache round trips. Unknown usernames are left out, and so
+        are users without a profile when with_profile is set.
+        """
+        users = User.objects.filter(username__in=usernames)
+        if with_profile:
+            users = users.filter(profile__isnull=False)
+        rows = list(users.values_list('id', 'username', 'profile__last_seen'))
+        user_ids = [user_id for user_id, _, _ in rows]
+        online = self.online_map(user_ids)
+        seen = self.last_seen_map(user_ids)
+        return {
+            username: (user_id, online[user_id], seen[user_id] or profile_seen)
+            for user_id, username, profile_seen in rows
+        }
+
+    async def flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            await database_sync_to_async(self._write)(pending)
+
+    def drain(self):
+        # Synchronous last-chance flush for interpreter shutdown
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._write(pending)
+
+    async def _offline_after_grace(self, user_id):
+        await asyncio.sleep(self.offline_grace)
+        if not self.is_online(user_id):
+            await self._go_offline(user_id)
+
+    async def _go_offline(self, user_id):
+        now = timezone.now()
+        await self.cache.adelete(self.connections_key(user_id))
+        await self.cache.aset(self.seen_key(user_id), now, None)
+        await self._record(user_id, now)
+        await self._publish(user_id, False, now)
+
+    async def _record(self, user_id, last_seen):
+        # The latest transition per user wins; one flush writes them all
+        self._pending[user_id] = last_seen
+        if not self.flush_interval:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: self._spawn(self.flush())
+            )
+
+    def _start_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        if self._heartbeat is None or self._heartbeat.done() or self._heartbeat.get_loop() is not loop:
+            self._heartbeat = loop.create_task(self._beat())
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.connection_ttl / 3)
+            for user_id, count in list(self._local.items()):
+                if not await self.cache.atouch(self.connections_key(user_id), self.connection_ttl):
+                    await self._restore(user_id, count)
+
+    async def _restore(self, user_id, count):
+        # Add back the sockets this process holds; other workers restore their own
+        key = self.connections_key(user_id)
+        await self.cache.aadd(key, 0, self.connection_ttl)
+        await self.cache.aincr(key, count)
+
+    async def _publish(self, user_id, online, last_seen):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        await channel_layer.group_send(self.group_name(user_id), {
+            'type': 'presence_event',
+            'user_id': user_id,
+            'online': online,
+            'last_seen': last_seen.isoformat() if last_seen else None,
+        })
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write(self, pending):
+        # One UPDATE per direction for the whole batch, plus an insert for users without a profile
+        online = [user_id for user_id, ts in pending.items() if ts is None]
+        seen = {user_id: ts for user_id, ts in pending.items() if ts is not None}
+        updated = 0
+        if online:
+            updated += Profile.objects.filter(user_id__in=online).update(is_online=True)
+        if seen:
+            updated += Profile.objects.filter(user_id__in=seen).update(
+                is_online=False,
+                last_seen=Case(
+                    *[When(user_id=user_id, then=Value(ts)) for user_id, ts in seen.items()],
+                    output_field=DateTimeField(),
+                ),
+            )
+        if updated < len(pending):
+            # Users deleted since their last transition are skipped
+            existing = set(Profile.objects.filter(user_id__in=pending).values_list('user_id', flat=True))
+            missing = User.objects.filter(id__in=set(pending) - existing).values_list('id', flat=True)
+            Profile.objects.bulk_create(
+                [
+                    Profile(user_id=user_id, is_online=pending[user_id] is None, last_seen=pending[user_id])
+                    for user_id in missing
+                ],
+                ignore_conflicts=True,
+            )
+
+
+_presence = None
+
+
+def get_presence():
+    """Return the process-wide presence tracker."""
+    global _presence
+    if _presence is None:
+        conf = get_presence_settings()
+        _presence = PresenceTracker(
+            conf['CACHE'], conf['OFFLINE_GRACE'], conf['FLUSH_INTERVAL'], conf['CONNECTION_TTL'],
+        )
+        atexit.register(_presence.drain)
+    return _presence
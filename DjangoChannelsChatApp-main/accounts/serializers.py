@@ -32,6 +32,55 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'room', 'sender', 'message', 'timestamp']
 
 
+class MessageLightSerializer(serializers.ModelSerializer):
+    # ?view=light: flat ids instead of nested objects, for integrations that page through history
+    room_id = serializers.IntegerField(read_only=True)
+    sender_id = serializers.IntegerField(read_only=True)
+    class Meta:
+        model = Message
+        fields = ['id', 'room_id', 'sender_id', 'message', 'timestamp', 'status']
+
+
+
+# Plain-function equivalents of the read serializers above. They produce the same
+# output without per-object field introspection and are used for GET requests.
+_datetime_field = serializers.DateTimeField()
+
+
+def user_data(user):
+    return {'id': user.id, 'username': user.username}
+
+
+def room_data(room):
+    # Expects participants to be prefetched
+    return {
+        'id': room.id,
+        'room_name': room.room_name,
+        'room_type': room.room_type,
+        'participants': [user_data(user) for user in room.participants.all()],
+    }
+
+
+def message_data(message):
+    return {
+        'id': message.id,
+        'room': room_data(message.room),
+        'sender': user_data(message.sender),
+        'message': message.message,
+        'timestamp': _datetime_field.to_representation(message.timestamp),
+    }
+
+
+def message_light_data(message):
+    return {
+        'id': message.id,
+        'room_id': message.room_id,
+        'sender_id': message.sender_id,
+        'message': message.message,
+        'timestamp': _datetime_field.to_representation(message.timestamp),
+        'status': message.status,
+    }
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
     email = serializers.EmailField(required=True)
@@ -0,0 +1,14 @@
+# accounts/signals.py
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .ws_auth import get_user_cache
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Deactivated or deleted users must not keep connecting from the cache
+    get_user_cache().discard(instance.pk)
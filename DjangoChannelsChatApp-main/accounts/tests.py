@@ -1,3 +1,271 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ChatApp.models import Message, Room
+from ChatApp.routing import websocket_urlpatterns
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Profile
+from .presence import PresenceTracker, get_presence
+from .ws_auth import TicketAuthMiddleware, get_user_cache, issue_ticket
+from .serializers import (
+    MessageLightSerializer, MessageSerializer, RoomSerializer, UserSerializer,
+    message_data, message_light_data, room_data, user_data,
+)
+
+
+class PresenceTrackerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice')
+        Profile.objects.create(user=self.user, is_online=True)
+        self.presence = PresenceTracker('default', offline_grace=0, flush_interval=0, connection_ttl=60)
+
+    def test_online_until_last_socket_closes(self):
+        async_to_sync(self.presence.connect)(self.user.id)
+        async_to_sync(self.presence.connect)(self.user.id)
+        async_to_sync(self.presence.disconnect)(self.user.id)
+        self.assertTrue(self.presence.is_online(self.user.id))
+        self.assertIsNone(Profile.objects.get(user=self.user).last_seen)
+
+        async_to_sync(self.presence.disconnect)(self.user.id)
+        self.assertFalse(self.presence.is_online(self.user.id))
+        profile = Profile.objects.get(user=self.user)
+        self.assertFalse(profile.is_online)
+        self.assertEqual(profile.last_seen, self.presence.last_seen(self.user.id))
+
+    def test_online_map(self):
+        other = User.objects.create_user(username='bob')
+        async_to_sync(self.presence.connect)(self.user.id)
+        self.assertEqual(self.presence.online_map([self.user.id, other.id]), {self.user.id: True, other.id: False})
+
+    def test_last_seen_is_written_for_users_without_profile(self):
+        other = User.objects.create_user(username='bob')
+        async_to_sync(self.presence.connect)(other.id)
+        async_to_sync(self.presence.disconnect)(other.id)
+        self.assertIsNotNone(Profile.objects.get(user=other).last_seen)
+
+    def test_profile_is_online_follows_transitions(self):
+        Profile.objects.filter(user=self.user).update(is_online=False)
+        async_to_sync(self.presence.connect)(self.user.id)
+        self.assertTrue(Profile.objects.get(user=self.user).is_online)
+        async_to_sync(self.presence.disconnect)(self.user.id)
+        self.assertFalse(Profile.objects.get(user=self.user).is_online)
+
+    def test_sockets_outliving_the_connection_ttl_stay_online(self):
+        presence = PresenceTracker('default', offline_grace=0, flush_interval=0, connection_ttl=0.3)
+
+        async def hold():
+            await presence.connect(self.user.id)
+            await presence.connect(self.user.id)
+            await asyncio.sleep(0.5)
+            self.assertTrue(presence.is_online(self.user.id))
+            # An evicted count must not turn the first close into an offline transition
+            cache.delete(presence.connections_key(self.user.id))
+            await presence.disconnect(self.user.id)
+            self.assertTrue(presence.is_online(self.user.id))
+            await presence.disconnect(self.user.id)
+
+        async_to_sync(hold)()
+        self.assertFalse(presence.is_online(self.user.id))
+        self.assertFalse(Profile.objects.get(user=self.user).is_online)
+
+
+class UserStatusAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice')
+        Profile.objects.create(user=self.user, is_online=True)
+        self.client.force_login(self.user)
+
+    def test_status_comes_from_presence(self):
+        # The stale Profile.is_online flag is ignored
+        response = self.client.get(reverse('user_status', args=['alice']))
+        self.assertEqual(response.json(), {'status': 'Offline', 'last_seen': None})
+
+
+class MessageViewSetTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.client.force_login(self.alice)
+        self.room = Room.objects.create(room_name='group_api', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+        self.other = Room.objects.create(room_name='group_other', room_type='group')
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.bob, message=f'm{i}').id
+            for i in range(5)
+        ]
+        Message.objects.create(room=self.other, sender=self.bob, message='elsewhere')
+        self.url = reverse('message-list')
+
+    def test_cursor_pages_cover_the_room(self):
+        data = self.client.get(self.url, {'room': self.room.id, 'page_size': 2}).json()
+        seen = [m['id'] for m in data['results']]
+        while data['next']:
+            data = self.client.get(data['next']).json()
+            seen += [m['id'] for m in data['results']]
+        self.assertEqual(seen, self.ids[::-1])
+
+    def test_nested_rows_do_not_query_per_message(self):
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, {'page_size': 2})
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(self.url, {'page_size': 6})
+        self.assertEqual(len(small), len(large))
+
+    def test_light_view_and_filters(self):
+        cutoff = Message.objects.get(id=self.ids[2]).timestamp
+        data = self.client.get(self.url, {
+            'view': 'light', 'room_name': self.room.room_name, 'since': cutoff.isoformat(),
+        }).json()
+        self.assertEqual([m['id'] for m in data['results']], self.ids[:1:-1])
+        self.assertEqual(data['results'][0]['room_id'], self.room.id)
+        self.assertNotIn('room', data['results'][0])
+
+    def test_invalid_filter(self):
+        self.assertEqual(self.client.get(self.url, {'since': 'yesterday'}).status_code, 400)
+
+
+class FastReadSerializerTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        self.room = Room.objects.create(room_name='group_fast', room_type='group')
+        self.room.participants.add(self.alice, self.bob)
+        self.message = Message.objects.create(room=self.room, sender=self.bob, message='hi')
+
+    def test_same_output_as_model_serializers(self):
+        message = Message.objects.select_related('room', 'sender').get(id=self.message.id)
+        self.assertEqual(user_data(self.alice), UserSerializer(self.alice).data)
+        self.assertEqual(room_data(self.room), RoomSerializer(self.room).data)
+        self.assertEqual(message_data(message), MessageSerializer(message).data)
+        self.assertEqual(message_light_data(message), MessageLightSerializer(message).data)
+
+    def test_endpoints_use_the_same_shape(self):
+        self.client.force_login(self.alice)
+        users = self.client.get(reverse('user-list')).json()
+        self.assertEqual(users, UserSerializer(User.objects.all(), many=True).data)
+        room = self.client.get(reverse('room-detail', args=[self.room.id])).json()
+        self.assertEqual(room, RoomSerializer(self.room).data)
+
+
+class BatchStatusAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='alice')
+        self.bob = User.objects.create_user(username='bob')
+        Profile.objects.bulk_create([Profile(user=self.alice), Profile(user=self.bob)])
+        self.client.force_login(self.alice)
+
+    def test_user_statuses_in_one_query(self):
+        async_to_sync(get_presence().connect)(self.bob.id)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('user_status_batch'), {'usernames': 'alice,bob,nobody'})
+        self.assertEqual(response.json(), {
+            'alice': {'status': 'Offline', 'last_seen': None},
+            'bob': {'status': 'Online', 'last_seen': None},
+            'nobody': {'status': 'Unknown user', 'last_seen': None},
+        })
+        # Session and user lookups for the request itself, then one for the statuses
+        self.assertEqual(len([q for q in ctx.captured_queries if 'auth_user' in q['sql'] and 'IN' in q['sql']]), 1)
+
+    def test_users_without_profile_are_unknown(self):
+        # Same answer as the single-user endpoint
+        User.objects.create_user(username='carol')
+        self.assertEqual(self.client.get(reverse('user_status', args=['carol'])).status_code, 404)
+        response = self.client.get(reverse('user_status_batch'), {'usernames': 'carol,alice'})
+        self.assertEqual(response.json(), {
+            'carol': {'status': 'Unknown user', 'last_seen': None},
+            'alice': {'status': 'Offline', 'last_seen': None},
+        })
+
+    def test_message_statuses(self):
+        room = Room.objects.create(room_name='group_status', room_type='group')
+        sent = Message.objects.create(room=room, sender=self.bob, message='hi')
+        read = Message.objects.create(room=room, sender=self.bob, message='hi', status='read')
+        response = self.client.post(
+            reverse('message_status_batch'), {'ids': [sent.id, read.id, 999]}, content_type='application/json',
+        )
+        self.assertEqual(response.json(), {str(sent.id): 'sent', str(read.id): 'read', '999': 'Unknown message'})
+        self.assertEqual(self.client.get(reverse('message_status_batch'), {'ids': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('message_status_batch')).status_code, 400)
+
+
+class WebSocketAuthTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        get_user_cache().clear()
+        self.addCleanup(get_presence().drain)
+        self.user = User.objects.create_user(username='alice', password='pw')
+
+    def connect(self, query='', headers=()):
+        async def run():
+            communicator = WebsocketCommunicator(
+                TicketAuthMiddleware(URLRouter(websocket_urlpatterns)), f'/ws/chat/{query}', headers=list(headers),
+            )
+            connected, _ = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected
+        return async_to_sync(run)()
+
+    def test_ticket_connects_and_reuses_cached_user(self):
+        ticket = issue_ticket(self.user)
+        self.assertTrue(self.connect(f'?ticket={ticket}'))
+        # A reconnect storm is served from the user cache
+        with mock.patch.object(User.objects, 'filter', side_effect=AssertionError('database hit')):
+            for _ in range(3):
+                self.assertTrue(self.connect(f'?ticket={ticket}'))
+
+    def test_jwt_access_token(self):
+        token = str(AccessToken.for_user(self.user))
+        self.assertTrue(self.connect(f'?token={token}'))
+        self.assertTrue(self.connect(headers=[(b'authorization', f'Bearer {token}'.encode())]))
+
+    def test_bad_or_expired_credentials_are_refused(self):
+        self.assertFalse(self.connect('?ticket=forged'))
+        self.assertFalse(self.connect('?token=forged'))
+        ticket = issue_ticket(self.user)
+        with override_settings(CHAT_WS_AUTH={'TICKET_MAX_AGE': -1}):
+            self.assertFalse(self.connect(f'?ticket={ticket}'))
+
+    def test_deactivated_user_leaves_the_cache(self):
+        ticket = issue_ticket(self.user)
+        self.assertTrue(self.connect(f'?ticket={ticket}'))
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.connect(f'?ticket={ticket}'))
+
+    def test_deactivated_jwt_user_is_refused(self):
+        token = str(AccessToken.for_user(self.user))
+        self.assertTrue(self.connect(f'?token={token}'))
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.connect(f'?token={token}'))
+
+    def test_jwt_with_a_non_integer_user_id_is_refused(self):
+        for user_id in ('abc', '1.0', 1.5, True, None):
+            token = AccessToken.for_user(self.user)
+            token['user_id'] = user_id
+            self.assertFalse(self.connect(f'?token={token}'))
+
+    def test_no_session_fallback_when_disabled(self):
+        with override_settings(CHAT_WS_AUTH={'SESSION_FALLBACK': False}):
+            self.assertFalse(self.connect())
+
+    def test_ticket_endpoint(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('ws_ticket'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.connect(f"?ticket={response.json()['ticket']}"))
@@ -3,6 +3,7 @@ from . import views
 from rest_framework import routers
 from .api import UserViewSet, ProfileViewSet, RoomViewSet, MessageViewSet
 from .api import RegisterAPIView, UserStatusAPIView, MessageStatusAPIView
+from .api import UserStatusBatchAPIView, MessageStatusBatchAPIView, WebSocketTicketAPIView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -23,7 +24,10 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/ws-ticket/', WebSocketTicketAPIView.as_view(), name='ws_ticket'),
     path('api/register/', RegisterAPIView.as_view(), name='api_register'),
+    path('api/user-status/', UserStatusBatchAPIView.as_view(), name='user_status_batch'),
     path('api/user-status/<str:username>/', UserStatusAPIView.as_view(), name='user_status'),
+    path('api/message-status/', MessageStatusBatchAPIView.as_view(), name='message_status_batch'),
     path('api/message-status/<int:message_id>/', MessageStatusAPIView.as_view(), name='message_status'),
 ]
\ No newline at end of file
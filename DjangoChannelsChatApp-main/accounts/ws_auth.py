@@ -0,0 +1,163 @@
+# accounts/ws_auth.py
+
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import signing
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+logger = logging.getLogger(__name__)
+
+WS_AUTH_DEFAULTS = {
+    'TICKET_MAX_AGE': 60,        # seconds a signed connect ticket stays valid
+    'USER_CACHE_TTL': 300,       # seconds a resolved user is reused before it is re-read
+    'USER_CACHE_SIZE': 10000,    # users kept per process
+    'SESSION_FALLBACK': True,    # clients without a ticket or token still get session auth
+}
+
+TICKET_SALT = 'accounts.ws_auth.ticket'
+
+
+def get_ws_auth_settings():
+    return {**WS_AUTH_DEFAULTS, **getattr(settings, 'CHAT_WS_AUTH', {})}
+
+
+def issue_ticket(user):
+    """A signed, short-lived WebSocket connect ticket for `user`; no server-side state."""
+    return signing.dumps({'u': user.pk}, salt=TICKET_SALT, compress=True)
+
+
+def parse_user_id(value):
+    # Tickets carry the id as a number and SimpleJWT as a string; the UserCache and the
+    # signals that evict from it use the integer pk, so anything else is rejected
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+
+def verify_ticket(ticket, max_age):
+    # Signature and age only; returns the user id or None
+    try:
+        return parse_user_id(signing.loads(ticket, salt=TICKET_SALT, max_age=max_age)['u'])
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+def verify_access_token(token):
+    # SimpleJWT access tokens are checked by signature and expiry, not against the database
+    try:
+        return parse_user_id(AccessToken(token)[jwt_settings.USER_ID_CLAIM])
+    except (TokenError, KeyError):
+        return None
+
+
+class UserCache:
+    """
+    Process-local LRU of resolved users with a TTL, so a reconnect storm costs
+    at most one User query per user and TTL. Entries are dropped when the user
+    is saved or deleted in this process; other processes catch up within the TTL.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        user, expires = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return user
+
+    def set(self, user_id, user):
+        self._entries[user_id] = (user, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def resolve(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            user = await database_sync_to_async(
+                User.objects.filter(pk=user_id, is_active=True).first
+            )()
+            if user is None:
+                return None
+            self.set(user_id, user)
+        return user
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    """Return the process-wide resolved-user cache."""
+    global _user_cache
+    if _user_cache is None:
+        conf = get_ws_auth_settings()
+        _user_cache = UserCache(conf['USER_CACHE_SIZE'], conf['USER_CACHE_TTL'])
+    return _user_cache
+
+
+def scope_credentials(scope):
+    # ?ticket=... (browsers), ?token=... or an "Authorization: Bearer ..." header (API clients)
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    ticket = query.get('ticket', [None])[0]
+    token = query.get('token', [None])[0]
+    for name, value in scope.get('headers', []):
+        if name == b'authorization' and value[:7].lower() == b'bearer ':
+            token = token or value[7:].decode('latin-1')
+    return ticket, token
+
+
+class TicketAuthMiddleware:
+    """
+    WebSocket auth from a signed ticket or a SimpleJWT access token.
+
+    Credentials are verified without the database and the user comes from
+    the UserCache. Connections that carry neither go through the session
+    based AuthMiddlewareStack unless SESSION_FALLBACK is off; invalid
+    credentials give an AnonymousUser, which the consumers refuse.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_stack = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        conf = get_ws_auth_settings()
+        ticket, token = scope_credentials(scope)
+        if ticket is None and token is None:
+            if conf['SESSION_FALLBACK']:
+                return await self.session_stack(scope, receive, send)
+            return await self.inner(dict(scope, user=AnonymousUser()), receive, send)
+        if ticket is not None:
+            user_id = verify_ticket(ticket, conf['TICKET_MAX_AGE'])
+        else:
+            user_id = verify_access_token(token)
+        user = await get_user_cache().resolve(user_id) if user_id is not None else None
+        if user is None:
+            logger.info("Rejected WebSocket credentials for %s", scope.get('path'))
+            user = AnonymousUser()
+        return await self.inner(dict(scope, user=user), receive, send)